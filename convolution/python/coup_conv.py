@@ -5,15 +5,26 @@ CESM.  Eventually, this will be the offline RVIC model.
 
 Written by Joe Hamman, May 2013
 """
-from netCDF4 import Dataset
+from netCDF4 import Dataset, num2date
 import numpy as np
 import glob
+import hashlib
+import json
+import struct
+import zlib
+import shutil
+import tempfile
 import os
+import re
 import sys  
 import ConfigParser
 import argparse
 import time as tm
+import heapq
+import multiprocessing
+from functools import partial
 from collections import OrderedDict, deque
+from scipy import sparse
 
 earthRadius = 6.37122e6  
 waterDensity = 1000.  
@@ -26,6 +37,16 @@ secsPerDay = hoursPerDay * secsPerHour
 mmPerMeter = 1000.
 cmPerMeter = 100.
 
+# change when the layout of the prepared snapshots changes
+SNAPSHOT_VERSION = 'prepared-2'
+
+# date in the flux file names (YYYY-MM-DD-SSSSS), replaced by the period in
+# consolidated output file names
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}-\d{5}')
+
+# first bytes of the binary checkpoints (see write_checkpoint)
+CHECKPOINT_MAGIC = 'RVICRING'
+
 def main(config_file=None):
     """
     The basic workflow of the main routine of the coupled model convolution is:
@@ -45,19 +66,27 @@ def main(config_file=None):
     if not config_file:
         config_file = process_command_line()
     
-    Config, uh_files, flux_files, 
-    grid_file, out_path, initial_state, 
-    outputs, options = process_config_file(config_file)
+    (Config, uh_files, flux_files, 
+     grid_file, out_path, initial_state, 
+     outputs, options) = process_config_file(config_file)
 
-    point_dict, out_dict, area, 
-    shape, counts = init(uh_files, flux_files, grid_file, 
-                         initial_state, outputs, options)
+    (point_dict, conv_dict, out_dict, area, 
+     shape, counts) = init(uh_files, flux_files, grid_file, 
+                           initial_state, outputs, options)
+
+    if options['async_writes'] > 0:
+        async_writer = start_async_writer(out_path, outputs, out_dict, shape,
+                                          options)
+    else:
+        async_writer = None
 
     out_name, state_name, restart_name, counts = run(Config, flux_files, out_path,
                                                      outputs, options, point_dict, 
-                                                     out_dict, area, shape, counts)
+                                                     conv_dict, out_dict, area, 
+                                                     shape, counts, 
+                                                     async_writer=async_writer)
 
-    final(counts, outputs, out_path)
+    final(counts, outputs, out_path, async_writer=async_writer)
 
     return
 
@@ -74,6 +103,9 @@ def init(uh_files, flux_files, grid_file, initial_state, outputs, options,
     counts['out_files'] = 0
     counts['state_files'] = 0
     counts['restart_files'] = 0
+    counts['flux_wait'] = 0.
+    counts['convolve_time'] = 0.
+    counts['write_time'] = 0.
 
     # find the grid cell area in square meters
     try:
@@ -103,7 +135,7 @@ def init(uh_files, flux_files, grid_file, initial_state, outputs, options,
             out_dict['latitudes'] = f.variables['yc'][:]
             shape = area.shape
         else:
-            shape = (len(uh_files), )
+            shape = None
         f.close()
     except:
         e = sys.exc_info()[0]
@@ -121,20 +153,32 @@ def init(uh_files, flux_files, grid_file, initial_state, outputs, options,
     if options['verbose']:
         print 'reading input files'
 
-    point_dict, out_dict, counts = make_point_dict(uh_files, area, out_dict, 
-                                   counts, rho_h20, initial_state=initial_state)
+    point_dict, conv_dict, out_dict, counts = make_point_dict(uh_files, area, 
+                                                 out_dict, counts, rho_h20, 
+                                                 initial_state=initial_state,
+                                                 param_file=options.get('param_file'),
+                                                 workers=options.get('load_workers', 1),
+                                                 verbose=options['verbose'],
+                                                 snapshot_dir=options.get('snapshot_dir'))
+    operator_stats(conv_dict)
+    conv_dict['flux_cells'] = flux_cells(conv_dict, area.shape, 
+                                         options.get('flux_read', 'strips'),
+                                         options['verbose'])
+    if not shape:
+        shape = (len(point_dict), )
 
-    return point_dict, out_dict, area, shape, counts
+    return point_dict, conv_dict, out_dict, area, shape, counts
 
 
 def run(Config, flux_files, out_path, outputs, options, point_dict, 
-        out_dict, area, shape, counts):
+        conv_dict, out_dict, area, shape, counts, async_writer=None):
     """
     - Loop over flux files
     - Combine the Baseflow and Runoff Variables
     - Adjust units as necessary
     - Do convolution
-    - Write output files
+    - Write output files (or hand them to async_writer, see 
+      start_async_writer)
     """
     state_name = None
     restart_name = None
@@ -142,84 +186,279 @@ def run(Config, flux_files, out_path, outputs, options, point_dict,
     if options['verbose']:
         print 'starting convolution now'
 
-    time_dict = {}
-    i = 0
-    while flux_files:
-        ff = flux_files.popleft()
-        i += 1
-        counts['timesteps'] += 1
-        # Check to see if it's time to save a state file
-        if any(date in ff for date in outputs['state']):
-            print 'making statefile from %s' % ff
-            return_state = True
-        else:
-            return_state = False
-
-        f = Dataset(ff, 'r')
-        # read time step
-        time_dict['time_step'] = f.variables['time'][:]
-        if i == 1:
-            time_dict['units'] = f.variables['time'].units
-            time_dict['cal'] = f.variables['time'].calendar
-            time_dict['long_name'] = f.variables['time'].long_name
-
-            # convert to m3/s
-            if f.output_frequency == 'hourly' and f.output_mode == 'instantaneous':
-                div = 1200  # assumes vic timestep of 20min  # BART COMMENT: I suspect this is hardcoded for RASM? We should eventually fix the RASM code to write this correctly
-            elif f.output_frequency == 'hourly' and f.output_mode == 'averaged':
-                div = secsPerHour  # averaged should really mean accumulated here
-                time_dict['output_frequency'] = 'hourly'
-            elif f.output_frequency == 'dailyy' and f.output_mode == 'averaged':  # note the typo in dailyy
-                div = secsPerDay
-            else:
-                print 'Unexpected flux output frequency %s, assuming it is hourly accumulated' % f.output_frequency
-                div = secsPerHour
-
-            if f.variables['Runoff'].units == 'mm':
-                div *= mmPerMeter
-            elif f.variables['Runoff'].units == 'cm':
-                div *= cmPerMeter
-            else:
-                print 'Unexpected flux units %s, assuming they are mm' % f.variables['Runoff'].units
-                div *= mmPerMeter
-
-        # BART COMMENT: We should do all the calculations in terms of mass (since that is what is conserved).
-        # I don't think this makes any difference in the calculations, but it would make for cleaner code
-        # BART COMMENT: The name of the variables should come from the configuration file.
-        # Get the fluxes and convert to m3
-        f.variables["Runoff"].set_auto_maskandscale(False)
-        f.variables['Baseflow'].set_auto_maskandscale(False)
-        flux = (f.variables['Runoff'][:] + f.variables['Baseflow'][:]) / div
+    # Read the flux files ahead in a background process (options['prefetch'] 
+    # files at most), in the order of flux_files.  A process rather than a 
+    # thread because the netCDF library is not thread safe.
+    if options.get('prefetch', 0) > 0:
+        flux_queue = multiprocessing.Queue(maxsize=options['prefetch'])
+        reader = multiprocessing.Process(target=prefetch_flux, 
+                                         args=(list(flux_files), flux_queue,
+                                               conv_dict.get('flux_cells')))
+        reader.daemon = True
+        reader.start()
+    else:
+        flux_queue = None
 
-        f.close()
+    # Convolve the outlets in options['conv_workers'] worker processes 
+    if options.get('conv_workers', 1) > 1:
+        conv_pool = start_conv_workers(conv_dict, options['conv_workers'], 
+                                       options.get('block_steps', 1), 
+                                       options['verbose'])
+    else:
+        conv_pool = None
 
-        # do the covolutions for this timestep
-        point_dict, out_flow, 
-        out_state, time_dict = convolve(point_dict, time_dict, flux, 
-                                        return_state, shape=shape)
+    # Streamflows are written to one file per out_period unless it is file,
+    # by the asynchronous writer if there is one
+    if async_writer is None:
+        writer = open_writer(out_path, outputs, out_dict, shape)
+    else:
+        writer = None
 
-        # write this timestep's streamflows to out_name
+    time_dict = {}
+    flux_info = None
+    out_state = None
+    chain = {}
+    while flux_files:
+        # Gather a block of options['block_steps'] timesteps, a block ends 
+        # early at a file that a state is saved for
+        block = []
+        steps = 0
+        return_state = False
+        while flux_files and steps < options.get('block_steps', 1) and \
+                not return_state:
+            ff = flux_files.popleft()
+            # Check to see if it's time to save a state file
+            if any(date in ff for date in outputs['state']):
+                print 'making statefile from %s' % ff
+                return_state = True
+
+            # Get the fluxes (m3/m2 per second), from the prefetch queue if 
+            # there is one
+            start = tm.time()
+            if flux_queue is not None:
+                item = flux_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                time_step, flux, flux_info = item
+            else:
+                time_step, flux, flux_info = read_flux(ff, flux_info, 
+                                                       conv_dict.get('flux_cells'))
+            counts['flux_wait'] += tm.time() - start
+            block.append((ff, time_step, flux.reshape(len(time_step), -1)))
+            steps += len(time_step)
+        counts['timesteps'] += steps
+        time_dict.update(flux_info['time'])
+
+        start = tm.time()
+        # do the covolutions for this block of timesteps
+        if conv_pool is None:
+            out_flows = convolve_block(conv_dict, 
+                                       np.concatenate([b[2] for b in block]), 
+                                       shape)
+        else:
+            out_flows = convolve_parallel(conv_pool, conv_dict, 
+                                          np.concatenate([b[2] for b in block]),
+                                          shape)
+            if return_state:
+                gather_rings(conv_pool, conv_dict)
+        if return_state and outputs['state_format'] == 'delta':
+            time_dict['time_step'] = block[-1][1]
+            time_dict['out_state_time'] = (conv_dict['time'] + 
+                                           np.atleast_1d(block[-1][1])[-1])
+        elif return_state and outputs['state_format'] == 'binary':
+            # the ring of all points, whatever the output type
+            time_dict['time_step'] = block[-1][1]
+            out_state = ring_state(conv_dict, time_dict, (len(point_dict), ))
+        elif return_state:
+            time_dict['time_step'] = block[-1][1]
+            out_state = ring_state(conv_dict, time_dict, shape)
+        counts['convolve_time'] += tm.time() - start
+        start = tm.time()
+
+        # write each file's streamflows to out_name (see write_task)
         # BART COMMENT: You should compare to False, not "false"
-        if outputs['out_type'] != "false":
-            out_name = os.path.join(out_path, os.path.split(ff)[1])
-            write_output(out_name, out_flow, out_dict, time_dict, "streamflow", options, shape=shape)
-            counts['out_files'] += 1
+        tasks = []
+        step = 0
+        for ff, time_dict['time_step'], flux in block:
+            out_flow = out_flows[step:step+len(flux)]
+            step += len(flux)
+            if outputs['out_type'] != "false":
+                out_name = os.path.join(out_path, os.path.split(ff)[1])
+                tasks.append(('streamflow', ff, out_name, out_flow, 
+                              dict(time_dict)))
 
         # write this timestep's state
         if return_state:
-            state_name = os.path.join(out_path, 'state_'+os.path.split(ff)[1])
             restart_name = os.path.join(out_path, 'restart_'+os.path.split(ff)[1][:-2]+'cfg')
-            write_output(state_name, out_state, out_dict, time_dict, "state", options, shape=shape)
+            if outputs['state_format'] == 'delta':
+                state_name = os.path.join(out_path, 'state_'+os.path.split(ff)[1][:-2]+'chk')
+                tasks.append(checkpoint_chain(chain, state_name, conv_dict, 
+                                              time_dict, outputs['base_every']))
+            elif outputs['state_format'] == 'binary':
+                state_name = os.path.join(out_path, 'state_'+os.path.split(ff)[1][:-2]+'ring')
+                tasks.append(('checkpoint', state_name, out_state, 
+                              dict(time_dict), conv_dict['y'], conv_dict['x']))
+            else:
+                state_name = os.path.join(out_path, 'state_'+os.path.split(ff)[1])
+                tasks.append(('state', state_name, out_state, dict(time_dict)))
             counts['state_files'] += 1
 
             # make an associated restart file
-            Config = write_restart(Config, state_name, restart_name, flux_files)
+            tasks.append(('restart', Config, state_name, restart_name, 
+                          list(flux_files)))
             counts['restart_files'] += 1
 
+        # write now, or queue for the asynchronous writer (blocks while its
+        # queue is full)
+        for task in tasks:
+            if async_writer is None:
+                counts['out_files'] += write_task(task, writer, out_dict, 
+                                                  options, shape)
+            else:
+                async_writer['tasks'].put(task)
+        counts['write_time'] += tm.time() - start
+
+    if writer:
+        close_writer(writer)
+        counts['out_files'] += writer['files']
+        print 'wrote %i streamflow files in %i flushes' % (writer['files'], 
+                                                           writer['flushes'])
+
+    if flux_queue is not None:
+        reader.join()
+
+    if conv_pool is not None:
+        gather_rings(conv_pool, conv_dict)
+        stop_conv_workers(conv_pool)
+
     return out_name, state_name, restart_name, counts
 
 
-def final(counts, outputs, out_path):
+def read_flux(flux_file, flux_info=None, cells=None):
+    """
+    Read the time step and the fluxes (Runoff + Baseflow) of one flux file,
+    converted to m3/m2 per second.  The time attributes and the unit 
+    conversion come from the first file (flux_info, returned for the 
+    following files).  With cells (see flux_cells) only the strips covering
+    the contributing cells are read and the fluxes of those cells returned
+    (timesteps x cells).
+    """
+    f = Dataset(flux_file, 'r')
+    # read time step
+    time_step = f.variables['time'][:]
+    if not flux_info:
+        flux_info = {'time':{}}
+        flux_info['time']['units'] = f.variables['time'].units
+        flux_info['time']['cal'] = f.variables['time'].calendar
+        flux_info['time']['long_name'] = f.variables['time'].long_name
+
+        # convert to m3/s
+        if f.output_frequency == 'hourly' and f.output_mode == 'instantaneous':
+            div = 1200  # assumes vic timestep of 20min  # BART COMMENT: I suspect this is hardcoded for RASM? We should eventually fix the RASM code to write this correctly
+        elif f.output_frequency == 'hourly' and f.output_mode == 'averaged':
+            div = secsPerHour  # averaged should really mean accumulated here
+            flux_info['time']['output_frequency'] = 'hourly'
+        elif f.output_frequency == 'dailyy' and f.output_mode == 'averaged':  # note the typo in dailyy
+            div = secsPerDay
+        else:
+            print 'Unexpected flux output frequency %s, assuming it is hourly accumulated' % f.output_frequency
+            div = secsPerHour
+
+        if f.variables['Runoff'].units == 'mm':
+            div *= mmPerMeter
+        elif f.variables['Runoff'].units == 'cm':
+            div *= cmPerMeter
+        else:
+            print 'Unexpected flux units %s, assuming they are mm' % f.variables['Runoff'].units
+            div *= mmPerMeter
+        flux_info['div'] = div
+
+    # BART COMMENT: We should do all the calculations in terms of mass (since that is what is conserved).
+    # I don't think this makes any difference in the calculations, but it would make for cleaner code
+    # BART COMMENT: The name of the variables should come from the configuration file.
+    # Get the fluxes and convert to m3
+    f.variables["Runoff"].set_auto_maskandscale(False)
+    f.variables['Baseflow'].set_auto_maskandscale(False)
+    if cells is None:
+        flux = (f.variables['Runoff'][:] + f.variables['Baseflow'][:]) / flux_info['div']
+    else:
+        runoff = read_cells(f.variables['Runoff'], cells)
+        baseflow = read_cells(f.variables['Baseflow'], cells)
+        flux = (runoff + baseflow) / flux_info['div']
+
+    f.close()
+    return time_step, flux, flux_info
+
+
+def read_cells(variable, cells):
+    """
+    Read the values of the contributing cells from a (time, y, x) flux 
+    variable, one hyperslab per strip of cells (see flux_cells).
+    """
+    values = [variable[:, y0:y1, x0:x1].reshape(variable.shape[0], -1)
+              for y0, y1, x0, x1 in cells['strips']]
+    return np.concatenate(values, axis=1)[:, cells['take']]
+
+
+def flux_cells(conv_dict, grid_shape, flux_read='strips', verbose=False):
+    """
+    Plan the flux reads of the contributing cells (conv_dict['sources']).
+    flux_read is
+    - strips: one hyperslab for each run of consecutive grid rows that have
+      contributing cells, spanning the columns of those cells
+    - box: the smallest hyperslab covering all contributing cells
+    - full: the full grid
+    Returns the strips (y0, y1, x0, x1) and the index of each contributing 
+    cell in the concatenated strips (take).
+    """
+    ys, xs = np.unravel_index(conv_dict['sources'], grid_shape)
+    if flux_read == 'full':
+        runs = [np.arange(len(ys))]
+        strips = [(0, grid_shape[0], 0, grid_shape[1])]
+    else:
+        if flux_read == 'strips':
+            # sources are in row major order, split where rows are skipped
+            runs = np.split(np.arange(len(ys)), 
+                            np.nonzero(np.diff(ys) > 1)[0] + 1)
+        elif flux_read == 'box':
+            runs = [np.arange(len(ys))]
+        else:
+            raise ValueError('unknown flux_read %s' % flux_read)
+        strips = [(ys[run].min(), ys[run].max()+1, xs[run].min(), 
+                   xs[run].max()+1) for run in runs if len(run)]
+
+    take = np.empty(len(ys), dtype=int)
+    offset = 0
+    for run, (y0, y1, x0, x1) in zip(runs, strips):
+        take[run] = offset + (ys[run] - y0)*(x1 - x0) + xs[run] - x0
+        offset += (y1 - y0)*(x1 - x0)
+
+    if verbose:
+        print 'flux reads (%s): %i strips, %i of %i grid cells for %i ' \
+            'contributing cells' % (flux_read, len(strips), offset, 
+                                    np.prod(grid_shape), len(ys))
+    return {'strips':strips, 'take':take}
+
+
+def prefetch_flux(flux_files, flux_queue, cells=None):
+    """
+    Read the flux files in order (see read_flux) and put them in flux_queue,
+    blocks while the queue is full.  Runs in a background process, a read 
+    error is put in the queue for run to raise.
+    """
+    flux_info = None
+    try:
+        for flux_file in flux_files:
+            time_step, flux, flux_info = read_flux(flux_file, flux_info, cells)
+            flux_queue.put((time_step, flux, flux_info))
+    except Exception as e:
+        flux_queue.put(e)
+    return
+
+
+def final(counts, outputs, out_path, async_writer=None):
+    if async_writer is not None:
+        stop_async_writer(async_writer, counts)
     print "-----------------------------------------------------------"
     print 'Done with streamflow convolution'
     print 'Processed %i timesteps' % counts['timesteps']
@@ -229,6 +468,9 @@ def final(counts, outputs, out_path):
     print 'Wrote %i output files' % counts['out_files']
     print 'Wrote %i state files' % counts['state_files']
     print 'Wrote %i restart files' % counts['restart_files']
+    print ('Time reading (or waiting for) fluxes %.2f s, convolving %.2f s, '
+           'writing %.2f s' % (counts['flux_wait'], counts['convolve_time'],
+                               counts['write_time']))
     print "-----------------------------------------------------------"
     return
 
@@ -257,6 +499,24 @@ def write_output(out_name, out_flow, out_dict, time_dict, out_type, options,
     """
     if options['verbose']:
         print 'writing %s' % out_name
+    f = create_output(out_name, out_dict, time_dict, out_type, shape)
+    if out_type == 'state':
+        f.variables['time'][:] = time_dict['out_state_time']
+        f.variables['Streamflow'][:] = out_flow
+    else:
+        f.variables['time'][:] = time_dict['time_step']
+        f.variables['Streamflow'][:] = out_flow.reshape((-1, ) + tuple(shape))
+    f.close()
+
+    return
+
+
+def create_output(out_name, out_dict, time_dict, out_type, shape):
+    """
+    Create a streamflow or state file (grid or array format) with its 
+    coordinates, time and Streamflow (along the unlimited time dimension) 
+    are left empty.  Returns the open Dataset.
+    """
     f = Dataset(out_name, 'w', format = 'NETCDF4')
 
     # Items that apply for all cases
@@ -268,10 +528,6 @@ def write_output(out_name, out_flow, out_dict, time_dict, out_type, options,
     time.calendar = time_dict['cal']
     time.longname = time_dict['long_name']
     time.type_prefered = 'double'
-    if out_type == 'state':
-        time[:] = time_dict['out_state_time']
-    else:
-        time[:] = time_dict['time_step']
 
     if len(shape) == 1:
         points = f.createDimension('point', shape[0])
@@ -303,10 +559,6 @@ def write_output(out_name, out_flow, out_dict, time_dict, out_type, options,
         flow = f.createVariable('Streamflow', 'f8', ('time', 'point', ))
         flow.description = 'Streamflow'
         flow.units = out_dict['units']
-        if out_type == 'state':
-            flow[:, :] = out_flow
-        else:
-            flow[0, :] = out_flow
     else:
         # Put all data into a grid
         x = f.createDimension('x', shape[1])
@@ -328,91 +580,442 @@ def write_output(out_name, out_flow, out_dict, time_dict, out_type, options,
         flow.description = 'Streamflow'
         flow.units = out_dict['units']
         flow.coordinates = 'longitude latitude'
-        if out_type == 'state':
-            flow[:, :, :] = out_flow
-        else:
-            flow[0, :, :] = out_flow
 
     # write attributes for netcdf
     if out_type == 'state':
         f.description = 'Streamflow state'
     else:
         f.description = 'Streamflow'
-    f.close()
 
+    return f
+
+
+def open_writer(out_path, outputs, out_dict, shape):
+    """
+    Setup the consolidated streamflow writer (a dict): one output file per
+    outputs['out_period'] (day, month or year), timesteps are buffered and
+    appended along the unlimited time dimension every outputs['flush_steps']
+    timesteps.  None if streamflows are written to one file per flux file.
+    """
+    if outputs['out_type'] == "false" or outputs['out_period'] == 'file':
+        return None
+    writer = {'out_path':out_path, 'period':outputs['out_period'], 
+              'flush_steps':outputs['flush_steps'], 'out_dict':out_dict, 
+              'shape':shape, 'key':None, 'name':None, 'file':None, 
+              'times':[], 'flows':[], 'files':0, 'flushes':0, 
+              'last_time':None, 'dropped':0}
+    return writer
+
+
+def period_key(time_step, time_dict, period):
+    """
+    The date of time_step for the output period: YYYY-MM-DD (day), YYYY-MM
+    (month) or YYYY (year)
+    """
+    date = num2date(time_step, time_dict['units'], time_dict['cal'])
+    if period == 'day':
+        return '%04i-%02i-%02i' % (date.year, date.month, date.day)
+    elif period == 'month':
+        return '%04i-%02i' % (date.year, date.month)
+    elif period == 'year':
+        return '%04i' % date.year
+    raise ValueError('Unknown output period %s' % period)
+
+
+def write_buffered(writer, flux_file, out_flow, time_dict, options):
+    """
+    Add the streamflows (timesteps x shape) of one flux file to the writer.
+    A new period flushes and closes the current file and opens the next one
+    (named as the flux file with the date of the period), an existing file
+    (from an earlier run) is appended to.  Timesteps not after the last time
+    already in the file (a rerun or restart) are dropped so its times stay 
+    in order.  Returns the current file name.
+    """
+    for time_step, flow in zip(np.atleast_1d(time_dict['time_step']), 
+                               out_flow):
+        key = period_key(time_step, time_dict, writer['period'])
+        if key != writer['key']:
+            close_writer(writer)
+            name = os.path.split(flux_file)[1]
+            if DATE_PATTERN.search(name):
+                name = DATE_PATTERN.sub(key, name)
+            else:
+                name = '%s.%s.nc' % (os.path.splitext(name)[0], key)
+            writer['name'] = os.path.join(writer['out_path'], name)
+            writer['key'] = key
+            writer['last_time'] = None
+            writer['dropped'] = 0
+            if os.path.exists(writer['name']):
+                writer['file'] = Dataset(writer['name'], 'a')
+                if len(writer['file'].dimensions['time']):
+                    writer['last_time'] = writer['file'].variables['time'][-1]
+            else:
+                if options['verbose']:
+                    print 'writing %s' % writer['name']
+                writer['file'] = create_output(writer['name'], 
+                                               writer['out_dict'], time_dict,
+                                               'streamflow', writer['shape'])
+                writer['files'] += 1
+        if writer['last_time'] is not None and time_step <= writer['last_time']:
+            if not writer['dropped']:
+                print 'WARNING: %s already has times up to %s, not written ' \
+                    'again' % (writer['name'], writer['last_time'])
+            writer['dropped'] += 1
+            continue
+        writer['last_time'] = time_step
+        writer['times'].append(time_step)
+        writer['flows'].append(flow)
+        if len(writer['times']) >= writer['flush_steps']:
+            flush_writer(writer)
+    return writer['name']
+
+
+def flush_writer(writer):
+    """
+    Append the buffered timesteps to the current file.
+    """
+    if not writer['times']:
+        return
+    f = writer['file']
+    start = len(f.dimensions['time'])
+    end = start + len(writer['times'])
+    f.variables['time'][start:end] = np.array(writer['times'])
+    f.variables['Streamflow'][start:end] = np.array(writer['flows'])
+    f.sync()
+    writer['times'] = []
+    writer['flows'] = []
+    writer['flushes'] += 1
+    return
+
+
+def close_writer(writer):
+    """
+    Flush and close the current file of the writer.
+    """
+    if writer['file']:
+        flush_writer(writer)
+        writer['file'].close()
+        writer['file'] = None
     return
 
 
-def make_point_dict(uh_files, area, out_dict, counts, rho_h20=1000, 
-                    initial_state=None):
+def write_task(task, writer, out_dict, options, shape):
     """
-    Read the initial state file if present
-    Open all the unit hydrograph grids and store in dictionary
-    Include location indecies
-    Turn IRFs to true Unit Hydrographs
-    Setup convolution structures in save dictionary
+    Do one write of run: ('streamflow', flux_file, out_name, out_flow, 
+    time_dict), ('state', state_name, out_state, time_dict), ('checkpoint', 
+    state_name, ring, time_dict, y, x), ('chain', state_name, header, data)
+    or ('restart', Config, state_name, restart_name, flux_files).  
+    Streamflows go to the consolidated writer if there is one.  Returns the
+    number of files written.
     """
-    # Create an ordered dictionary so that we can trust that the outputs will 
-    # always be the same
-    point_dict = OrderedDict()
+    if task[0] == 'streamflow':
+        flux_file, out_name, out_flow, time_dict = task[1:]
+        if writer:
+            write_buffered(writer, flux_file, out_flow, time_dict, options)
+            return 0
+        write_output(out_name, out_flow, out_dict, time_dict, "streamflow", 
+                     options, shape=shape)
+        return 1
+    elif task[0] == 'state':
+        state_name, out_state, time_dict = task[1:]
+        write_output(state_name, out_state, out_dict, time_dict, "state", 
+                     options, shape=shape)
+    elif task[0] == 'checkpoint':
+        write_checkpoint(*task[1:])
+    elif task[0] == 'chain':
+        write_chain(*task[1:])
+    elif task[0] == 'restart':
+        Config, state_name, restart_name, flux_files = task[1:]
+        write_restart(Config, state_name, restart_name, flux_files)
+    return 0
+
+
+def write_checkpoint(state_name, ring, time_dict, y, x):
+    """
+    Write a binary checkpoint of the unwrapped ring (ring length x points),
+    see write_state_file.
+    """
+    start = tm.time()
+    ring = np.ascontiguousarray(ring, dtype='<f8')
+    write_state_file(state_name, state_header('ring', ring.shape, time_dict, 
+                                              y, x), ring.tostring())
+    print 'wrote checkpoint %s (%.2f MB) in %.3f s' % (state_name, 
+                                                       ring.nbytes/1.e6, 
+                                                       tm.time() - start)
+    return
 
-    counts['points'] = 0
 
-    for i, uh_file in enumerate(uh_files):
-        counts['points'] += 1
-        d = {}
-        f = Dataset(uh_file, 'r')
-        if f.variables['time'].units == "seconds since 0-01-01 00:00:00":
-            # convert to ordinal of day since...
-            d['time'] = f.variables['time'][:]/86400
-        else:
-            # for now assume they are in days since 0-01-01 00:00:00
-            d['time'] = f.variables['time'][:]
+def write_chain(state_name, header, ring):
+    """
+    Write a checkpoint of the checkpoint chain (see checkpoint_chain): a 
+    base with the raw ring (ring layout, not unwrapped), or a delta with the
+    zlib compressed changed rows (xor of the ring bits with the parent's).
+    """
+    start = tm.time()
+    ring = np.ascontiguousarray(ring)
+    if header['kind'] == 'base':
+        data = ring.tostring()
+    else:
+        data = zlib.compress(ring.tostring(), 1)
+    write_state_file(state_name, header, data)
+    print 'wrote %s checkpoint %s (%.3f MB) in %.3f s' % (header['kind'], 
+                                                          state_name, 
+                                                          len(data)/1.e6,
+                                                          tm.time() - start)
+    return
 
-        # Get basin indicies
-        d['xi'] = f.variables['xi'][:]
-        d['yi'] = f.variables['yi'][:]
 
-        # Get grid outlet locations
-        d['x'] = f.outlet_x
-        d['y'] = f.outlet_y
-        d['lat'] = f.outlet_lat
-        d['lon'] = f.outlet_lon
+def state_header(kind, shape, time_dict, y, x, **kwargs):
+    """
+    Header of a binary checkpoint: its kind (ring, base or delta), ring 
+    shape, state time and the outlet locations of the columns.
+    """
+    header = {'kind':kind, 'shape':shape, 
+              'time':np.ma.getdata(time_dict['out_state_time']).tolist(),
+              'units':time_dict['units'], 'calendar':time_dict['cal'],
+              'y':np.asarray(y).tolist(), 'x':np.asarray(x).tolist()}
+    header.update(kwargs)
+    return header
 
-        # make unit hydrograph (no longer has volume of 1)
-        # divide by outlet grid cell's area
-        if out_dict['units'] == 'kg/m2*s':
-            d['uh'] = f.variables['unit_hydrograph'][:]*f.variables['fraction'][:]*area[d['yi'], d['xi']]*rho_h20/area[d['y'], d['x']]
-        elif out_dict['units'] == 'm3/s':
-            d['uh'] = f.variables['unit_hydrograph'][:]*f.variables['fraction'][:]*area[d['yi'], d['xi']]
 
-        f.close()
+def write_state_file(state_name, header, data):
+    """
+    Write a binary checkpoint file: CHECKPOINT_MAGIC, the length of the 
+    header, the header (json) and the data, aligned to 64 bytes so a raw 
+    ring can be memory mapped.  The file is written under a temporary name 
+    and renamed, so a checkpoint is either complete or not there.
+    """
+    header = json.dumps(header)
+    offset = len(CHECKPOINT_MAGIC) + 8 + len(header)
+    offset += -offset % 64
+
+    temp_name = state_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write('\0' * (offset - f.tell()))
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_name, state_name)
+    return
 
-        d['now'] = 0
 
-        # If there is an inital state, put that in the ring, if not, make a 
-        # ring of zeros
-        if not initial_state:
-            d['ring'] = np.zeros(len(d['uh']))
+def read_state_header(state_name):
+    """
+    Returns the header of a binary checkpoint and the offset of its data.
+    """
+    with open(state_name, 'rb') as f:
+        f.seek(len(CHECKPOINT_MAGIC))
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length))
+    offset = len(CHECKPOINT_MAGIC) + 8 + length
+    offset += -offset % 64
+    return header, offset
+
+
+def is_checkpoint(state_name):
+    """
+    True if state_name is a binary checkpoint (see write_state_file).
+    """
+    with open(state_name, 'rb') as f:
+        return f.read(len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC
+
+
+def read_checkpoint(state_name, point_dict, conv_dict):
+    """
+    Put a binary checkpoint in the convolution ring.  A ring checkpoint is 
+    memory mapped, a delta checkpoint is replayed on its base (see 
+    read_chain).  The columns are matched to the points by outlet location.
+    """
+    start = tm.time()
+    header, offset = read_state_header(state_name)
+    if header.get('kind', 'ring') == 'ring':
+        state = np.memmap(state_name, dtype='<f8', mode='r', offset=offset, 
+                          shape=tuple(header['shape']))
+    else:
+        state = read_chain(state_name)
+
+    columns = dict((key, i) for i, key in enumerate(point_dict))
+    order = [columns[key] for key in zip(header['y'], header['x'])]
+    if order == range(len(point_dict)):
+        conv_dict['ring'][:len(state)] = state
+    else:
+        conv_dict['ring'][:len(state), order] = state
+    del state
+    print 'read checkpoint %s in %.3f s' % (state_name, tm.time() - start)
+    return
+
+
+def read_chain(state_name):
+    """
+    Replay a checkpoint chain: the base ring (memory mapped) with the 
+    deltas from the base up to state_name applied in order.  Returns the 
+    unwrapped ring.
+    """
+    chain = []
+    name = state_name
+    while True:
+        header, offset = read_state_header(name)
+        chain.append((name, header, offset))
+        if header['kind'] == 'base':
+            break
+        name = os.path.join(os.path.dirname(name), header['parent'])
+
+    name, header, offset = chain.pop()
+    ring = np.array(np.memmap(name, dtype='<f8', mode='r', offset=offset, 
+                              shape=tuple(header['shape'])))
+    bits = ring.view(np.uint64)
+    while chain:
+        name, header, offset = chain.pop()
+        with open(name, 'rb') as f:
+            f.seek(offset)
+            delta = np.fromstring(zlib.decompress(f.read()), dtype=np.uint64)
+        rows = np.array(header['rows'], dtype=int)
+        bits[rows] ^= delta.reshape(len(rows), -1)
+    head = header['head']
+    return np.concatenate((ring[head:], ring[:head]))
+
+
+def checkpoint_chain(chain, state_name, conv_dict, time_dict, base_every):
+    """
+    Make the next write of the checkpoint chain (chain is a dict kept by 
+    run).  Every base_every checkpoints (and the first) is a base with the 
+    whole ring, the others are deltas with only the ring rows that changed
+    since the previous checkpoint.  Returns the write task (see write_task).
+    """
+    ring = conv_dict['ring']
+    head = conv_dict['head']
+    if not chain or chain['count'] % base_every == 0:
+        header = state_header('base', ring.shape, time_dict, conv_dict['y'], 
+                              conv_dict['x'], head=head)
+        data = ring.copy()
+    else:
+        bits = ring.view(np.uint64)
+        rows = np.nonzero((bits != chain['bits']).any(axis=1))[0]
+        header = state_header('delta', ring.shape, time_dict, conv_dict['y'],
+                              conv_dict['x'], head=head, rows=rows.tolist(),
+                              parent=os.path.basename(chain['name']))
+        data = bits[rows] ^ chain['bits'][rows]
+    chain['bits'] = ring.view(np.uint64).copy()
+    chain['name'] = state_name
+    chain['count'] = chain.get('count', 0) + 1
+    return ('chain', state_name, header, data)
+
+
+def start_async_writer(out_path, outputs, out_dict, shape, options):
+    """
+    Start the asynchronous writer, a process that does the writes of run 
+    (see write_task) in the order they are queued.  The queue holds 
+    options['async_writes'] writes at most, run waits when it is full.  A 
+    process rather than a thread because the netCDF library is not thread
+    safe.  Stopped (and flushed) by stop_async_writer.
+    """
+    async_writer = {}
+    async_writer['tasks'] = multiprocessing.Queue(maxsize=options['async_writes'])
+    async_writer['results'] = multiprocessing.Queue()
+    async_writer['process'] = multiprocessing.Process(target=async_writes,
+        args=(async_writer['tasks'], async_writer['results'], out_path, 
+              outputs, out_dict, shape, options))
+    async_writer['process'].daemon = True
+    async_writer['process'].start()
+    return async_writer
+
+
+def async_writes(tasks, results, out_path, outputs, out_dict, shape, options):
+    """
+    Main loop of the asynchronous writer process: write the queued tasks 
+    until None, then put the number of files written and the time spent 
+    writing in results.  After an error, the remaining tasks are dropped 
+    (so run does not block) and the error is put in results.
+    """
+    writer = open_writer(out_path, outputs, out_dict, shape)
+    stats = {'out_files':0, 'write_time':0.}
+    error = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if error:
+            continue
+        start = tm.time()
+        try:
+            stats['out_files'] += write_task(task, writer, out_dict, options, 
+                                             shape)
+        except Exception as e:
+            error = e
+        stats['write_time'] += tm.time() - start
+    if writer and not error:
+        try:
+            close_writer(writer)
+            stats['out_files'] += writer['files']
+        except Exception as e:
+            error = e
+    results.put(error or stats)
+    return
+
+
+def stop_async_writer(async_writer, counts):
+    """
+    Wait for the asynchronous writer to finish the queued writes, add its
+    files and time to counts.
+    """
+    start = tm.time()
+    async_writer['tasks'].put(None)
+    result = async_writer['results'].get()
+    async_writer['process'].join()
+    if isinstance(result, Exception):
+        raise result
+    counts['out_files'] += result['out_files']
+    print ('asynchronous writer: %.2f s writing, waited %.2f s for it to '
+           'finish' % (result['write_time'], tm.time() - start))
+    return
 
-        # store each individual point dictionary in the larger point_dict
-        key = (d['y'], d['x'])
-        point_dict[key] = d
 
-    if initial_state:
+def make_point_dict(uh_files, area, out_dict, counts, rho_h20=1000, 
+                    initial_state=None, param_file=None, workers=1, 
+                    verbose=False, snapshot_dir=None):
+    """
+    Read the initial state file if present
+    Read the unit hydrographs (see read_points) and setup the convolution 
+    ring (conv_dict), or load both from a prepared snapshot in snapshot_dir
+    """
+    # Use the prepared snapshot of these inputs if there is one
+    snapshot = None
+    if snapshot_dir:
+        snapshot = os.path.join(snapshot_dir, 'prepared_%s' % 
+                                snapshot_key(uh_files, param_file, area, 
+                                             out_dict['units'], rho_h20))
+    if snapshot and os.path.exists(snapshot):
+        point_dict, conv_dict = load_snapshot(snapshot)
+        counts['points'] = len(point_dict)
+    else:
+        point_dict = read_points(uh_files, area, out_dict, counts, rho_h20, 
+                                 param_file, workers, verbose)
+        conv_dict = make_conv_dict(point_dict, area.shape)
+        if snapshot:
+            save_snapshot(snapshot, point_dict, conv_dict)
+
+    # If there is an inital state, put that in the ring
+    if initial_state and is_checkpoint(initial_state):
+        print "Reading Initial State Checkpoint: %s" % initial_state
+        read_checkpoint(initial_state, point_dict, conv_dict)
+    elif initial_state:
         print "Reading Initial State File: %s" % initial_state
         f = Dataset(initial_state, 'r')
         state = f.variables['Streamflow'][:]
+        columns = dict((key, i) for i, key in enumerate(point_dict))
 
         if state.ndim == 3:
-            for i, (key, d) in enumerate(point_dict.iteritems()):
-                point_dict[key]['ring'] = state[:, key[0], key[1]]
+            for i, key in enumerate(point_dict):
+                conv_dict['ring'][:len(state), i] = state[:, key[0], key[1]]
         else:
+            x_outlets = f.variables['xi'][:]
+            y_outlets = f.variables['yi'][:]
             for i in xrange(state.shape[1]):
-                x_outlets = f.variables['xi'][:]
-                y_outlets = f.variables['yi'][:]
                 key = (y_outlets[i], x_outlets[i])
-                point_dict[key]['ring'] = state[:, i]
+                conv_dict['ring'][:len(state), columns[key]] = state[:, i]
         f.close()
 
     # Now make a few numpy arrays from the point dict that will go in each 
@@ -427,58 +1030,757 @@ def make_point_dict(uh_files, area, out_dict, counts, rho_h20=1000,
         out_dict['outlet_ys'][i] = d['y']
         out_dict['outlet_xs'][i] = d['x']
 
-    return point_dict, out_dict, counts
+    return point_dict, conv_dict, out_dict, counts
 
 
-def convolve(point_dict, time_dict, flux, return_state, shape):
+def read_points(uh_files, area, out_dict, counts, rho_h20=1000, 
+                param_file=None, workers=1, verbose=False):
     """
-    This convoluition funciton works by looping over all points and doing the
-    convolution one timestep at a time.  This is accomplished by creating an
-    convolution ring.  Contributing flow from each timestep is added to the
-    convolution ring.  The convolution ring is unwrapped when state is being 
-    saved.
+    Open all the unit hydrograph grids and store in dictionary
+    (or read them all from one RVIC parameter file, see read_param_file)
+    The files are read by a pool of worker processes if workers > 1 (the 
+    netCDF library is not thread safe)
+    Include location indecies
+    Turn IRFs to true Unit Hydrographs
     """
-    out_flow = np.zeros(shape)
-    if out_flow.ndim == 1:
+    # Create an ordered dictionary so that we can trust that the outputs will 
+    # always be the same
+    point_dict = OrderedDict()
+
+    counts['points'] = 0
+
+    if param_file:
+        point_dict = read_param_file(param_file, area, out_dict, rho_h20)
+        counts['points'] = len(point_dict)
+        uh_files = []
+
+    # Read the unit hydrograph files (in a pool of workers if asked for), 
+    # map returns them in the order of uh_files
+    reader = partial(read_uh_file, area=area, units=out_dict['units'],
+                     rho_h20=rho_h20)
+    start = tm.time()
+    if workers > 1 and len(uh_files) > 1:
+        how = 'process pool, %i workers' % workers
+        pool = multiprocessing.Pool(workers)
+        results = pool.map(reader, uh_files)
+        pool.close()
+        pool.join()
+    else:
+        how = 'serial'
+        results = map(reader, uh_files)
+    elapsed = tm.time() - start
+
+    for uh_file, (d, file_time) in zip(uh_files, results):
+        counts['points'] += 1
+        if verbose:
+            print '%.3f s reading %s' % (file_time, uh_file)
+
+        # store each individual point dictionary in the larger point_dict
+        key = (d['y'], d['x'])
+        point_dict[key] = d
+
+    if results:
+        file_times = np.array([r[1] for r in results])
+        slowest = file_times.argmax()
+        print ('read %i unit hydrograph files in %.2f s (%s): %.3f s mean, '
+               '%.3f s max (%s)' % (len(results), elapsed, how, 
+                                    file_times.mean(), file_times[slowest], 
+                                    uh_files[slowest]))
+
+    return point_dict
+
+
+def read_uh_file(uh_file, area, units, rho_h20=1000):
+    """
+    Read one unit hydrograph file into a point dictionary, with the unit
+    hydrograph in units.  Returns the point dictionary and the time it 
+    took (seconds, reading and scaling) so slow files can be spotted.
+    """
+    d = {}
+    start = tm.time()
+    f = Dataset(uh_file, 'r')
+    if f.variables['time'].units == "seconds since 0-01-01 00:00:00":
+        # convert to ordinal of day since...
+        d['time'] = f.variables['time'][:]/86400
+    else:
+        # for now assume they are in days since 0-01-01 00:00:00
+        d['time'] = f.variables['time'][:]
+
+    # Get basin indicies
+    d['xi'] = f.variables['xi'][:]
+    d['yi'] = f.variables['yi'][:]
+
+    # Subset unit hydrographs (see adjust_fractions.subset) start 
+    # time_offset timesteps after the impulse
+    if 'time_offset' in f.variables:
+        d['time_offset'] = f.variables['time_offset'][:].astype(int)
+    else:
+        d['time_offset'] = np.zeros(len(d['xi']), dtype=int)
+    try:
+        d['full_length'] = int(f.variables['time'].full_length)
+    except AttributeError:
+        d['full_length'] = len(d['time'])
+
+    # Get grid outlet locations
+    d['x'] = f.outlet_x
+    d['y'] = f.outlet_y
+    d['lat'] = f.outlet_lat
+    d['lon'] = f.outlet_lon
+
+    unit_hydrograph = f.variables['unit_hydrograph'][:]
+    fraction = f.variables['fraction'][:]
+    f.close()
+
+    # make unit hydrograph (no longer has volume of 1)
+    # divide by outlet grid cell's area
+    if units == 'kg/m2*s':
+        d['uh'] = unit_hydrograph*fraction*area[d['yi'], d['xi']]*rho_h20/area[d['y'], d['x']]
+    elif units == 'm3/s':
+        d['uh'] = unit_hydrograph*fraction*area[d['yi'], d['xi']]
+
+    return d, tm.time() - start
+
+
+def read_param_file(param_file, area, out_dict, rho_h20=1000):
+    """
+    Read the unit hydrographs of all outlets from one RVIC parameter file
+    (see adjust_fractions.write_param_file), a few bulk reads instead of one
+    file per outlet.  The point dictionaries are the same as those from the
+    unit hydrograph files.  uh_point already includes the fraction and
+    the area ratio (source cell area / outlet cell area).
+    """
+    point_dict = OrderedDict()
+
+    f = Dataset(param_file, 'r')
+    uh_point = f.variables['uh_point'][:]
+    x_ind_point = f.variables['x_ind_point'][:].astype(int)
+    y_ind_point = f.variables['y_ind_point'][:].astype(int)
+    t_offset_point = f.variables['t_offset_point'][:].astype(int)
+    point2outlet = f.variables['point2outlet_index'][:].astype(int)
+    x_ind_outlet = f.variables['x_ind_outlet'][:].astype(int)
+    y_ind_outlet = f.variables['y_ind_outlet'][:].astype(int)
+    lon_outlet = f.variables['lon_outlet'][:]
+    lat_outlet = f.variables['lat_outlet'][:]
+    full_length = int(f.variables['full_length'][...])
+    # time is in timesteps of timestep seconds, make it days
+    time = f.variables['time'][:]*float(f.variables['timestep'][...])/secsPerDay
+    f.close()
+
+    # points of each outlet (in file order)
+    order = np.argsort(point2outlet, kind='mergesort')
+    bounds = np.searchsorted(point2outlet[order], 
+                             np.arange(len(x_ind_outlet)+1))
+
+    for n in xrange(len(x_ind_outlet)):
+        points = order[bounds[n]:bounds[n+1]]
+        d = {}
+        d['time'] = time
+        d['xi'] = x_ind_point[points]
+        d['yi'] = y_ind_point[points]
+        d['time_offset'] = t_offset_point[points]
+        d['full_length'] = full_length
+
+        d['x'] = x_ind_outlet[n]
+        d['y'] = y_ind_outlet[n]
+        d['lat'] = lat_outlet[n]
+        d['lon'] = lon_outlet[n]
+
+        if out_dict['units'] == 'kg/m2*s':
+            d['uh'] = uh_point[:, points]*rho_h20
+        elif out_dict['units'] == 'm3/s':
+            d['uh'] = uh_point[:, points]*area[d['y'], d['x']]
+
+        key = (d['y'], d['x'])
+        point_dict[key] = d
+
+    return point_dict
+
+
+def make_conv_dict(point_dict, grid_shape):
+    """
+    Setup the convolution structures for all points at once.  The unit 
+    hydrographs (with fractions and unit conversions) of all points make one
+    sparse (CSR) linear operator from the flux of every contributing grid 
+    cell (conv_dict['sources'], flat grid indices in row major order) to the
+    ring increment of every (lag, point), row lag*points+point.  Each source
+    cell only has weights in its window, the nonzero lags of its unit 
+    hydrograph shifted by its time_offset.  The unit hydrographs are only 
+    kept in the operator, 'uh' is deleted from every point of (point_dict) 
+    (modified in place) as it is added.  The ring is long enough for the full
+    length unit hydrographs.
+    One convolution ring for all points (ring length x points).  Time is
+    advanced by moving the head, the ring unwrapped from the head is the 
+    hydrograph still to come at each point (see unwrap_ring).
+    """
+    conv_dict = {}
+    npoints = len(point_dict)
+
+    rows, cols, weights = [], [], []
+    conv_dict['uh_bytes'] = 0
+    conv_dict['full_weights'] = 0
+    ring_length = 0
+    for i, d in enumerate(point_dict.itervalues()):
+        lags, sources = np.nonzero(d['uh'])
+        weights.append(d['uh'][lags, sources])
+        lags = lags + d['time_offset'][sources]
+        if len(lags):
+            ring_length = max(ring_length, lags.max()+1)
+        ring_length = max(ring_length, d['full_length'])
+        conv_dict['full_weights'] += d['full_length']*len(d['xi'])
+        rows.append(lags*npoints + i)
+        cols.append(np.ravel_multi_index((d['yi'][sources], d['xi'][sources]),
+                                         grid_shape))
+        conv_dict['uh_bytes'] += d['uh'].nbytes
+        del d['uh']
+    cols = np.concatenate(cols)
+    conv_dict['sources'] = np.unique(cols)
+    conv_dict['operator'] = sparse.csr_matrix((np.concatenate(weights), 
+                                               (np.concatenate(rows), 
+                                                np.searchsorted(conv_dict['sources'],
+                                                                cols))),
+                                              shape=(ring_length*npoints, 
+                                                     len(conv_dict['sources'])))
+
+    # time of the state files, extended to the full ring length
+    time = point_dict.itervalues().next()['time']
+    if len(time) < ring_length:
+        if len(time) > 1:
+            step = time[1] - time[0]
+        else:
+            step = 1
+        time = np.append(time, time[-1] + step*np.arange(1, ring_length - 
+                                                          len(time) + 1))
+    conv_dict['time'] = time[:ring_length]
+
+    conv_dict['ring'] = np.zeros((ring_length, npoints))
+    conv_dict['head'] = 0
+    conv_dict['y'] = np.array([key[0] for key in point_dict], dtype=int)
+    conv_dict['x'] = np.array([key[1] for key in point_dict], dtype=int)
+    flat_index(conv_dict, grid_shape)
+    return conv_dict
+
+
+def operator_stats(conv_dict, repeats=5):
+    """
+    Print the size of the convolution operator and time its sparse 
+    matrix-vector product.
+    """
+    operator = conv_dict['operator']
+    nbytes = (operator.data.nbytes + operator.indices.nbytes + 
+              operator.indptr.nbytes)
+    flux = np.ones(operator.shape[1])
+    start = tm.time()
+    for i in xrange(repeats):
+        operator.dot(flux)
+    spmv_time = (tm.time() - start)/repeats
+    print 'convolution operator: %i x %i, %i nonzeros' % (operator.shape + 
+                                                           (operator.nnz, ))
+    print 'multiply-adds per timestep: %i of %i (%.1f%% zeros skipped)' \
+        % (operator.nnz, conv_dict['full_weights'], 
+           100.*(1 - float(operator.nnz)/max(conv_dict['full_weights'], 1)))
+    print 'operator memory: %.2f MB (unit hydrographs were %.2f MB)' \
+        % (nbytes/1.e6, conv_dict['uh_bytes']/1.e6)
+    print 'SpMV: %.3f ms per timestep, %.1f Mflop/s' \
+        % (spmv_time*1.e3, 2.*operator.nnz/max(spmv_time, 1.e-9)/1.e6)
+    return
+
+
+def snapshot_key(uh_files, param_file, area, units, rho_h20):
+    """
+    Hash of everything the prepared point data is made from: the unit 
+    hydrograph files (names, sizes and modification times), the grid cell
+    areas and the output units.
+    """
+    key = hashlib.sha1()
+    key.update(SNAPSHOT_VERSION)
+    if param_file:
+        uh_files = [param_file]
+    for uh_file in uh_files:
+        stat = os.stat(uh_file)
+        key.update('%s %i %r' % (os.path.abspath(uh_file), stat.st_size, 
+                                 stat.st_mtime))
+    key.update(np.ascontiguousarray(np.ma.getdata(area), dtype=float).tostring())
+    key.update('%s %r' % (units, rho_h20))
+    return key.hexdigest()
+
+
+def save_snapshot(snapshot, point_dict, conv_dict):
+    """
+    Save the prepared point data (the convolution operator, outlet locations
+    and state time) as a directory of .npy files that load_snapshot can 
+    memory map.  The directory is written under a temporary name and 
+    renamed, so a snapshot is either complete or not there.
+    """
+    start = tm.time()
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot))
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    temp_dir = tempfile.mkdtemp(dir=snapshot_dir)
+
+    operator = conv_dict['operator']
+    arrays = {'data':operator.data, 'indices':operator.indices, 
+              'indptr':operator.indptr, 'time':conv_dict['time'],
+              'sources':conv_dict['sources'],
+              'y':conv_dict['y'], 'x':conv_dict['x'],
+              'lat':np.array([d['lat'] for d in point_dict.itervalues()]),
+              'lon':np.array([d['lon'] for d in point_dict.itervalues()])}
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(temp_dir, name + '.npy'), np.ma.getdata(array))
+    header = {'shape':operator.shape, 'ring_length':len(conv_dict['ring']),
+              'uh_bytes':conv_dict['uh_bytes'], 
+              'full_weights':conv_dict['full_weights']}
+    with open(os.path.join(temp_dir, 'header.json'), 'w') as f:
+        json.dump(header, f)
+
+    try:
+        os.rename(temp_dir, snapshot)
+    except OSError:
+        # another run saved it first
+        shutil.rmtree(temp_dir)
+    print 'saved prepared snapshot %s in %.3f s' % (snapshot, tm.time() - start)
+    return
+
+
+def load_snapshot(snapshot):
+    """
+    Load the point_dict and conv_dict saved by save_snapshot, the operator 
+    arrays are memory mapped.  Only the outlet locations are kept in 
+    point_dict (the unit hydrographs are in the operator).
+    """
+    start = tm.time()
+    with open(os.path.join(snapshot, 'header.json')) as f:
+        header = json.load(f)
+    arrays = {}
+    for name in ['data', 'indices', 'indptr', 'time', 'sources', 'y', 'x', 
+                 'lat', 'lon']:
+        arrays[name] = np.load(os.path.join(snapshot, name + '.npy'), 
+                               mmap_mode='r')
+
+    conv_dict = {}
+    conv_dict['operator'] = sparse.csr_matrix((arrays['data'], 
+                                               arrays['indices'],
+                                               arrays['indptr']), 
+                                              shape=tuple(header['shape']),
+                                              copy=False)
+    conv_dict['uh_bytes'] = header['uh_bytes']
+    conv_dict['full_weights'] = header['full_weights']
+    conv_dict['time'] = np.array(arrays['time'])
+    conv_dict['sources'] = np.array(arrays['sources'])
+    conv_dict['y'] = np.array(arrays['y'])
+    conv_dict['x'] = np.array(arrays['x'])
+    conv_dict['ring'] = np.zeros((header['ring_length'], len(conv_dict['y'])))
+    conv_dict['head'] = 0
+
+    point_dict = OrderedDict()
+    for i in xrange(len(conv_dict['y'])):
+        d = {'y':conv_dict['y'][i], 'x':conv_dict['x'][i], 
+             'lat':arrays['lat'][i], 'lon':arrays['lon'][i]}
+        point_dict[(d['y'], d['x'])] = d
+    print 'loaded prepared snapshot %s in %.3f s' % (snapshot, tm.time() - start)
+    return point_dict, conv_dict
+
+
+def convolve(point_dict, conv_dict, time_dict, flux, return_state, shape):
+    """
+    This convoluition funciton does the convolution of all points one 
+    timestep at a time (see convolve_block).
+    The convolution ring is unwrapped when state is being saved.
+    """
+    out_flow = convolve_block(conv_dict, flux.reshape(1, -1), shape)[0]
+
+    #get the starting state for the next timestep from the ring
+    if return_state:
+        out_state = ring_state(conv_dict, time_dict, shape)
+    else:
+        out_state = None
+        time_dict['out_state_time'] = None
+
+    return conv_dict, out_flow, out_state, time_dict
+
+
+def convolve_block(conv_dict, fluxes, shape):
+    """
+    Convolve a block of consecutive timesteps (fluxes is timesteps x grid 
+    cells or timesteps x contributing cells, see read_flux).  This is 
+    accomplished by creating an convolution ring.  The 
+    flow of every (lag, point) for all timesteps of the block is one sparse
+    matrix-matrix product of the convolution operator and the fluxes.  
+    Contributing flow from each timestep is added to the convolution ring 
+    starting at its head, the head value is the streamflow of this 
+    timestep.  The timesteps are added to the ring in order, so the results
+    are the same as convolving one timestep at a time.
+    Returns the streamflow of each timestep (timesteps x shape).
+    """
+    steps = len(fluxes)
+    out_flow = np.zeros((steps, ) + tuple(shape))
+    if len(shape) == 1:
         out_type = 'array'
     else:
         out_type = 'grid'
 
-    for i, (point, d) in enumerate(point_dict.iteritems()):
-        if i == 0:
-            if return_state and out_type == 'array':
-                out_state = np.zeros((len(d['uh']), shape[0]))
-                time_dict['out_state_time'] = d['time'] + time_dict['time_step']
-            elif return_state and out_type == 'grid':
-                out_state = np.zeros((len(d['uh']), shape[0], shape[1]))
-                time_dict['out_state_time'] = d['time'] + time_dict['time_step']
-            else:
-                out_state = None
-                time_dict['out_state_time'] = None
+    ring = conv_dict['ring']
+    ring_length = len(ring)
+
+    # Get the convolved hydrographs from the fluxes of the contributing cells
+    if fluxes.shape[1] != conv_dict['operator'].shape[1]:
+        fluxes = fluxes[:, conv_dict['sources']]
+    flows = np.ascontiguousarray(conv_dict['operator'].dot(fluxes.T).T)
+
+    if out_type == 'array':
+        point_flow = out_flow
+    elif out_type == 'grid':
+        point_flow = np.empty((steps, ring.shape[1]))
+
+    for step in xrange(steps):
+        head = conv_dict['head']
 
-        # Get the convolved hydrograph from the flux and add to convolution ring
-        d['ring'] += (flux[:, d['yi'], d['xi']]*d['uh']).sum(axis=1)
+        # Add this timestep's flow to the convolution ring
+        flow = flows[step].reshape(ring_length, -1)
+        ring[head:] += flow[:ring_length-head]
+        ring[:head] += flow[ring_length-head:]
 
         # Store the streamflow for this timestep
-        if out_type == 'array':
-            out_flow[i] = d['ring'][0]
-        elif out_type == 'grid':
-            out_flow[d['y'], d['x']] = d['ring'][0]
+        point_flow[step] = ring[head]
+
+        # Set the current ring value to 0 and advance the head
+        ring[head] = 0
+        conv_dict['head'] = (head+1) % ring_length
+
+    # Put the streamflows of all timesteps on the grid at once
+    if out_type == 'grid':
+        out_flow.reshape(steps, -1)[:, flat_index(conv_dict, shape)] = point_flow
+
+    return out_flow
+
+
+def ring_state(conv_dict, time_dict, shape):
+    """
+    Get the starting state for the next timestep from the ring (the 
+    unwrapped ring, on the grid for grid outputs) and its time.
+    """
+    time_step = np.atleast_1d(time_dict['time_step'])[-1]
+    time_dict['out_state_time'] = conv_dict['time'] + time_step
+    if len(shape) == 1:
+        out_state = unwrap_ring(conv_dict)
+    else:
+        out_state = np.zeros((len(conv_dict['ring']), shape[0], shape[1]))
+        out_state.reshape(len(out_state), -1)[:, flat_index(conv_dict, shape)] = \
+            unwrap_ring(conv_dict)
+    return out_state
+
+
+def flat_index(conv_dict, shape):
+    """
+    Flat (raveled) grid index of each point's outlet, computed once and 
+    kept in conv_dict, so grid outputs are filled with one scatter.
+    """
+    if conv_dict.get('flat_shape') != tuple(shape):
+        conv_dict['flat'] = np.ravel_multi_index((conv_dict['y'], 
+                                                  conv_dict['x']), shape)
+        conv_dict['flat_shape'] = tuple(shape)
+    return conv_dict['flat']
+
+
+def unwrap_ring(conv_dict):
+    """
+    Returns the convolution ring starting at its head (ring length x points),
+    the layout of the state files.
+    """
+    ring = conv_dict['ring']
+    head = conv_dict['head']
+    return np.concatenate((ring[head:], ring[:head]))
+
+
+def partition_points(conv_dict, workers):
+    """
+    Split the points into workers groups with about the same number of 
+    source cells (largest first to the group with the fewest).  Returns the
+    sorted point indices of each group and the source cells of each group.
+    """
+    operator = conv_dict['operator']
+    npoints = conv_dict['ring'].shape[1]
+    # source cells of each point, the distinct columns of its rows
+    points = np.repeat(np.arange(operator.shape[0]) % npoints, 
+                       np.diff(operator.indptr))
+    pairs = np.unique(points.astype(np.int64)*operator.shape[1] + 
+                      operator.indices)
+    sources = np.bincount(pairs // operator.shape[1], minlength=npoints)
+
+    heap = [(0, w) for w in xrange(workers)]
+    groups = [[] for w in xrange(workers)]
+    for point in np.argsort(-sources, kind='mergesort'):
+        load, w = heapq.heappop(heap)
+        groups[w].append(point)
+        heapq.heappush(heap, (load + sources[point], w))
+    groups = [np.sort(np.array(group, dtype=int)) for group in groups]
+    return groups, [sources[group].sum() for group in groups]
+
+
+def start_conv_workers(conv_dict, workers, block_steps, verbose=False):
+    """
+    Start the convolution worker processes, each convolves the outlets of 
+    one group from partition_points with its own operator rows and ring.
+    The fluxes of a block of up to block_steps timesteps are published to 
+    shared memory once for all workers (conv_pool['flux']), each worker 
+    writes its streamflows to its columns of conv_pool['flows'] (in the 
+    order of conv_pool['order']).  The rings are in shared memory too, so 
+    gather_rings can collect them without copying through a pipe.
+    """
+    operator = conv_dict['operator']
+    ring_length, npoints = conv_dict['ring'].shape
+    groups, sources = partition_points(conv_dict, workers)
+    groups = [group for group in groups if len(group)]
+
+    conv_pool = {'groups':groups, 'order':np.concatenate(groups), 
+                 'steps':block_steps, 'connections':[], 'processes':[], 
+                 'rings':[]}
+    conv_pool['flux'] = np.frombuffer(multiprocessing.RawArray('d', 
+                                      block_steps*operator.shape[1])
+                                      ).reshape(block_steps, -1)
+    conv_pool['flows'] = np.frombuffer(multiprocessing.RawArray('d', 
+                                       block_steps*npoints)
+                                       ).reshape(block_steps, -1)
+    begin = 0
+    for group in groups:
+        # the operator rows of this group's points, lag*len(group)+point
+        rows = (np.arange(ring_length)[:, None]*npoints + group).ravel()
+        ring = np.frombuffer(multiprocessing.RawArray('d', ring_length*len(group))
+                             ).reshape(ring_length, -1)
+        ring[:] = conv_dict['ring'][:, group]
+        worker_dict = {'operator':operator_rows(operator, rows), 'ring':ring, 
+                       'head':conv_dict['head']}
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=conv_worker, 
+                                          args=(worker_connection, worker_dict,
+                                                conv_pool['flux'], 
+                                                conv_pool['flows'], begin, 
+                                                begin + len(group)))
+        process.daemon = True
+        process.start()
+        conv_pool['connections'].append(connection)
+        conv_pool['processes'].append(process)
+        conv_pool['rings'].append(ring)
+        begin += len(group)
+
+    if verbose:
+        print 'convolution workers: %i, source cells per worker %i to %i' \
+            % (len(groups), min(sources), max(sources))
+    return conv_pool
+
+
+def operator_rows(operator, rows):
+    """
+    The rows of a CSR operator, with the entries of each row in the same 
+    order (so the products are the same as with the full operator).
+    """
+    starts = operator.indptr[rows]
+    lengths = operator.indptr[rows + 1] - starts
+    indptr = np.append(0, np.cumsum(lengths))
+    entries = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+    return sparse.csr_matrix((operator.data[entries], operator.indices[entries],
+                              indptr), shape=(len(rows), operator.shape[1]))
 
-        #Set the current ring value to 0
-        d['ring'][d['now']] = 0
 
-        # Shift the ring
-        d['ring'] = shift(d['ring'], 1)
+def conv_worker(connection, conv_dict, fluxes, flows, begin, end):
+    """
+    Convolution worker process (see start_conv_workers), convolves the 
+    first steps rows of the shared fluxes for each steps it receives, None 
+    stops it.  Sends None when done or the error.
+    """
+    while True:
+        steps = connection.recv()
+        if steps is None:
+            break
+        try:
+            flows[:steps, begin:end] = convolve_block(conv_dict, 
+                                                      fluxes[:steps], 
+                                                      (end - begin, ))
+            connection.send(None)
+        except Exception as e:
+            connection.send(e)
+    connection.close()
+    return
 
-        #get the starting state for the next timestep from the ring
-        if return_state and out_type == 'array':
-            out_state[:, i] = d['ring']
-        elif return_state and out_type == 'grid':
-            out_state[:, point[0], point[1]] = d['ring']
-        point_dict[point] = d
 
-    return point_dict, out_flow, out_state, time_dict
+def convolve_parallel(conv_pool, conv_dict, fluxes, shape):
+    """
+    Convolve a block of timesteps with the convolution workers (see 
+    start_conv_workers), conv_pool['steps'] timesteps at a time.  Returns 
+    the same streamflows as convolve_block, the rings in conv_dict are only
+    brought up to date by gather_rings.
+    """
+    if fluxes.shape[1] != conv_dict['operator'].shape[1]:
+        fluxes = fluxes[:, conv_dict['sources']]
+    steps = len(fluxes)
+    point_flow = np.empty((steps, len(conv_pool['order'])))
+    for start in xrange(0, steps, conv_pool['steps']):
+        end = min(start + conv_pool['steps'], steps)
+        conv_pool['flux'][:end-start] = fluxes[start:end]
+        for connection in conv_pool['connections']:
+            connection.send(end - start)
+        errors = [connection.recv() for connection in conv_pool['connections']]
+        for error in errors:
+            if error is not None:
+                raise error
+        point_flow[start:end, conv_pool['order']] = conv_pool['flows'][:end-start]
+    conv_dict['head'] = (conv_dict['head'] + steps) % len(conv_dict['ring'])
+
+    if len(shape) == 1:
+        return point_flow
+    out_flow = np.zeros((steps, ) + tuple(shape))
+    out_flow.reshape(steps, -1)[:, flat_index(conv_dict, shape)] = point_flow
+    return out_flow
+
+
+def gather_rings(conv_pool, conv_dict):
+    """
+    Copy the rings of the convolution workers to conv_dict['ring'] (the 
+    workers are idle between convolve_parallel calls).
+    """
+    for group, ring in zip(conv_pool['groups'], conv_pool['rings']):
+        conv_dict['ring'][:, group] = ring
+    return
+
+
+def stop_conv_workers(conv_pool):
+    """
+    Stop the convolution workers and wait for them.
+    """
+    for connection in conv_pool['connections']:
+        connection.send(None)
+    for process in conv_pool['processes']:
+        process.join()
+    return
+
+
+class ConvolutionModel(object):
+    """
+    In memory coupling interface to the convolution, for a coupler that 
+    hands over the fluxes of each timestep and takes the streamflow back 
+    without any file I/O per step:
+        model = ConvolutionModel()
+        model.initialize(config_file)
+        model.step(flux, time)
+        streamflow = model.get_streamflow()
+    The fluxes are Runoff + Baseflow in m3/m2 per second (as read_flux 
+    returns them), on the grid or for the contributing cells only, one 
+    timestep (step) or several (step_block, timesteps x grid or timesteps 
+    x cells).  The state is the hydrograph still to come at each point (see
+    unwrap_ring).
+    """
+
+    def initialize(self, config_file):
+        """
+        Read the configuration file and the unit hydrographs and initial 
+        state (see init).  Flux files and outputs in the configuration file
+        are not used.
+        """
+        (Config, uh_files, flux_files, 
+         grid_file, out_path, initial_state, 
+         outputs, options) = process_config_file(config_file)
+        (self.point_dict, conv_dict, self.out_dict, area, 
+         shape, self.counts) = init(uh_files, flux_files, grid_file, 
+                                    initial_state, outputs, options)
+        self.initialize_from(conv_dict, area.shape, shape, 
+                             options['conv_workers'], options['verbose'])
+        return
+
+    def initialize_from(self, conv_dict, grid_shape, shape, conv_workers=1, 
+                        verbose=False):
+        """
+        Start from a prepared conv_dict (see make_conv_dict) for fluxes on 
+        grid_shape, with streamflow of the given shape, the grid or 
+        (points, ).
+        """
+        self.conv_dict = conv_dict
+        self.grid_shape = tuple(grid_shape)
+        self.shape = tuple(shape)
+        self.time = None
+        self.streamflow = None
+        if conv_workers > 1:
+            self.conv_pool = start_conv_workers(conv_dict, conv_workers, 1, 
+                                                verbose)
+        else:
+            self.conv_pool = None
+        return
+
+    def step(self, flux, time):
+        """
+        Convolve the fluxes of one timestep (grid or contributing cells).  
+        time is only stored (see get_state), it is not checked for order or 
+        gaps.
+        """
+        flux = np.asarray(flux, dtype=float)
+        self.streamflow = self.convolve_steps(flux.reshape(1, -1))[0]
+        self.time = time
+        return
+
+    def step_block(self, fluxes, time):
+        """
+        Convolve the fluxes of consecutive timesteps (timesteps x grid or 
+        timesteps x contributing cells), time is that of the last one and, 
+        as in step, only stored.
+        """
+        fluxes = np.asarray(fluxes, dtype=float)
+        self.streamflow = self.convolve_steps(fluxes.reshape(len(fluxes), -1))
+        self.time = time
+        return
+
+    def convolve_steps(self, fluxes):
+        """
+        Streamflow (timesteps x shape) of the fluxes (timesteps x cells) in 
+        this process or on the convolution workers.
+        """
+        if fluxes.shape[1] not in [int(np.prod(self.grid_shape)), 
+                                   self.conv_dict['operator'].shape[1]]:
+            raise ValueError('%i flux cells, expected the %s grid or the %i '
+                             'contributing cells' % (fluxes.shape[1], 
+                             self.grid_shape, 
+                             self.conv_dict['operator'].shape[1]))
+        if self.conv_pool is None:
+            return convolve_block(self.conv_dict, fluxes, self.shape)
+        return convolve_parallel(self.conv_pool, self.conv_dict, fluxes, 
+                                 self.shape)
+
+    def get_streamflow(self):
+        """
+        Streamflow of the last step (shape, or timesteps x shape).
+        """
+        return self.streamflow
+
+    def get_state(self):
+        """
+        The convolution state: the hydrograph still to come at each point 
+        (ring length x points) and the time of the last step.
+        """
+        if self.conv_pool is not None:
+            gather_rings(self.conv_pool, self.conv_dict)
+        return {'ring':unwrap_ring(self.conv_dict), 'time':self.time}
+
+    def set_state(self, state):
+        """
+        Restore a state from get_state.
+        """
+        self.conv_dict['ring'][:] = state['ring']
+        self.conv_dict['head'] = 0
+        self.time = state['time']
+        if self.conv_pool is not None:
+            # restart the workers with the new rings
+            stop_conv_workers(self.conv_pool)
+            self.conv_pool = start_conv_workers(self.conv_dict, 
+                                                len(self.conv_pool['groups']), 
+                                                1)
+        return
+
+    def finalize(self):
+        """
+        Stop the convolution workers, if any.
+        """
+        if self.conv_pool is not None:
+            gather_rings(self.conv_pool, self.conv_dict)
+            stop_conv_workers(self.conv_pool)
+            self.conv_pool = None
+        return
 
 
 def process_command_line():
@@ -504,6 +1806,36 @@ def process_config_file(config_file):
         options['verbose'] = Config.getboolean("Options", "verbose")
     except:
         options['verbose'] = False
+    # Number of worker processes reading the uh_files
+    try:
+        options['load_workers'] = Config.getint("Options", "load_workers")
+    except:
+        options['load_workers'] = 1
+    # Number of flux files read ahead on a background process (0 for none)
+    try:
+        options['prefetch'] = Config.getint("Options", "prefetch")
+    except:
+        options['prefetch'] = 0
+    # Number of timesteps convolved at once (see convolve_block)
+    try:
+        options['block_steps'] = Config.getint("Options", "block_steps")
+    except:
+        options['block_steps'] = 1
+    # Number of queued writes of the asynchronous writer (0 for none)
+    try:
+        options['async_writes'] = Config.getint("Options", "async_writes")
+    except:
+        options['async_writes'] = 0
+    # Number of convolution worker processes (see start_conv_workers)
+    try:
+        options['conv_workers'] = Config.getint("Options", "conv_workers")
+    except:
+        options['conv_workers'] = 1
+    # Flux cells read each timestep: strips, box or full (see flux_cells)
+    try:
+        options['flux_read'] = Config.get("Options", "flux_read")
+    except:
+        options['flux_read'] = 'strips'
     # Read Outputs Section
     outputs = {}
     try:
@@ -524,12 +1856,49 @@ def process_config_file(config_file):
         outputs["state"] = Config.get("Outputs", "state").split(', ')
     except:
         outputs["state"] = False
+    # State files as netcdf or binary checkpoints (see write_checkpoint)
+    try:
+        outputs["state_format"] = Config.get("Outputs", "state_format")
+    except:
+        outputs["state_format"] = "netcdf"
+    try:
+        outputs["base_every"] = Config.getint("Outputs", "base_every")
+    except:
+        outputs["base_every"] = 24
+    if outputs["base_every"] < 1:
+        raise ValueError('base_every must be at least 1, not %i' 
+                         % outputs["base_every"])
     try:
         outputs["case_name"] = Config.get("Outputs", "case_name")
     except:
         pass
+    # One streamflow file per flux file or per day, month or year
+    try:
+        outputs["out_period"] = Config.get("Outputs", "out_period")
+    except:
+        outputs["out_period"] = "file"
+    try:
+        outputs["flush_steps"] = Config.getint("Outputs", "flush_steps")
+    except:
+        outputs["flush_steps"] = 24
     # Read Paths section
-    uh_files = deque(sorted(glob.glob(Config.get("Paths", "uh_files"))))
+    # A single RVIC parameter file can be used instead of the uh_files
+    try:
+        options['param_file'] = Config.get("Paths", "param_file")
+    except:
+        options['param_file'] = None
+    # Directory of prepared snapshots (see save_snapshot)
+    try:
+        options['snapshot_dir'] = Config.get("Paths", "snapshot_dir")
+    except:
+        options['snapshot_dir'] = None
+    try:
+        uh_files = deque(sorted(glob.glob(Config.get("Paths", "uh_files"))))
+    except:
+        if not options['param_file']:
+            raise IOError('REQUIRED FILES NOT PROVIDED:  uh_files or '
+                          'param_file')
+        uh_files = deque()
 
     f = Config.get("Paths", "flux_files").split(', ')
     if len(f) > 1:
@@ -5,12 +5,23 @@ Routing algorithm developed by D. Lohmann.
 """
 
 ##############################################################################
+import os
 import sys
 import numpy as np
 import argparse
 import ConfigParser
 import time as tm
+import json
+import signal
+import socket
+import threading
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
 from netCDF4 import Dataset
+from scipy.spatial import cKDTree
+
+earthRadius = 6.37122e6 # meters
 
 ##############################################################################
 ###############################  MAIN PROGRAM ################################
@@ -20,45 +31,148 @@ def main(config_file = None):
     (infile, UHfile, Plons, Plats, 
      velocity, diffusion, verbose,
      NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, 
-     PREC, OUTPUT_INTERVAL, DAY_SECONDS) = process_command_line(config_file = config_file)
+     PREC, OUTPUT_INTERVAL, DAY_SECONDS, 
+     out_type, out_file, domain_file, 
+     subset, threshold, network_file, 
+     serve_address, workers, upscale, 
+     direction_units) = process_command_line(config_file = config_file)
+
+    if upscale:
+        domain = upscale_domain(infile, domain_file, velocity, diffusion, 
+                                verbose, direction_units = direction_units)
+    elif os.path.isdir(infile):
+        domain = read_ascii_domain(infile, velocity, diffusion, verbose, 
+                                   direction_units = direction_units)
+    else:
+        domain = None
+
+    if network_file:
+        network_domain = domain_file if upscale else None
+        if not os.path.exists(network_file):
+            make_network(infile, network_file, verbose, domain = domain, 
+                         domain_file = network_domain)
+        network = load_network(network_file, infile, verbose, 
+                               domain_file = network_domain)
+    else:
+        network = None
+
+    if serve_address:
+        serve(serve_address, workers, infile, UHfile, velocity, diffusion, 
+              verbose, NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, 
+              OUTPUT_INTERVAL, DAY_SECONDS, network, domain = domain)
+        return
 
-    for i, (basin_y, basin_x) in enumerate(zip(Plats, Plons)):
-        out_file = rout(infile, UHfile, basin_y, basin_x, velocity,diffusion, 
+    reset_output(out_type, out_file, verbose)
+    if out_type == 'rvic_params':
+        param_writer = open_param_writer(out_file, domain_file)
+    else:
+        param_writer = None
+    results = iter_rout(infile, UHfile, Plats, Plons, velocity, diffusion, 
                         verbose, NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, 
-                        OUTPUT_INTERVAL, DAY_SECONDS)
+                        OUTPUT_INTERVAL, DAY_SECONDS, network = network,
+                        domain = domain)
+    for i, result in enumerate(results):
+        out_name = write_result(result, out_type, out_file, NODATA, verbose,
+                                domain_file = domain_file, subset = subset, 
+                                threshold = threshold, 
+                                param_writer = param_writer)
         if verbose:
             print 'Finished routing to point %i of %i (%f, %f)' \
-                    % (i+1, len(Plons), basin_y, basin_x)
-            print 'Wrote %s' % out_file
+                    % (i+1, result['outlets'], result['lat'], result['lon'])
+            print 'Wrote %s' % out_name
+    if out_type == 'rvic_params':
+        close_param_writer(param_writer)
+        adjust_param_fractions(out_file, domain_file, verbose)
     if verbose:
         print 'Routing Program Finished.'
     return
         
 def rout(infile, UHfile, basin_y, basin_x, velocity, diffusion, verbose,
-    NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, DAY_SECONDS):
-
-    Basin, dy, dx, basin_id = init(infile, basin_y, basin_x, velocity, diffusion, verbose)
-       
+    NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, DAY_SECONDS,
+    out_type = 'grid', out_file = None, domain_file = None, subset = 0,
+    threshold = 0, network = None, domain = None):
+    """
+    Route to a single outlet and write the result, returns the output file.
+    """
     # Load UH_BOX input
     (uh_t,UH_Box) = load_uh(UHfile, verbose)
+
+    result = route_outlet(infile, uh_t, UH_Box, basin_y, basin_x, velocity, 
+                          diffusion, verbose, NODATA, CELL_FLOWTIME, 
+                          BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, DAY_SECONDS,
+                          network = network, domain = domain)
+
+    return write_result(result, out_type, out_file, NODATA, verbose,
+                        domain_file = domain_file, subset = subset, 
+                        threshold = threshold)
+
+def iter_rout(infile, UHfile, Plats, Plons, velocity, diffusion, verbose,
+    NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, DAY_SECONDS,
+    network = None, domain = None):
+    """
+    Generator that routes to each (Plats, Plons) outlet in turn and yields 
+    its result dictionary (see route_outlet) without writing anything.  Only
+    one outlet is held in memory at a time.  All outlets are snapped to the 
+    grid up front, outlets in the same grid cell are routed only once 
+    (result['outlets'] is the number routed).
+    """
+    (uh_t,UH_Box) = load_uh(UHfile, verbose)
+    if domain is None and os.path.isdir(infile):
+        domain = read_ascii_domain(infile, velocity, diffusion, verbose)
+    if domain is None:
+        f = Dataset(infile, 'r')
+        lats, lons = f.variables['lat'][:], f.variables['lon'][:]
+        f.close()
+    else:
+        lats, lons = domain['lat'], domain['lon']
+    outlets = snap_outlets(lats, lons, Plats, Plons, verbose)
+    for basin_y, basin_x, outlet_loc in outlets:
+        result = route_outlet(infile, uh_t, UH_Box, basin_y, basin_x, velocity,
+                              diffusion, verbose, NODATA, CELL_FLOWTIME, 
+                              BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, 
+                              DAY_SECONDS, network = network, domain = domain, 
+                              outlet_loc = outlet_loc)
+        result['outlets'] = len(outlets)
+        yield result
+
+def route_outlet(infile, uh_t, UH_Box, basin_y, basin_x, velocity, diffusion,
+    verbose, NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, 
+    DAY_SECONDS, network = None, domain = None, outlet_loc = None):
+    """
+    Route to a single outlet.  Returns the result as a dictionary holding the
+    compacted UH_S of the catchment cells, using the coup_conv point names:
+    uh [time, point], fraction, yi/xi (global indices of the catchment cells),
+    y/x and lat/lon (outlet), time (seconds), plus basin_id, velocity, 
+    diffusion, lats/lons (of the catchment cells), time_step, time_res and
+    grid (the subset coordinates and local indices used by write_netcdf).
+    (outlet_loc) is the global (y, x) index of the outlet if already snapped.
+    """
+    Basin, dy, dx, basin_id = init(infile, basin_y, basin_x, velocity, diffusion,
+                                   verbose, domain = domain, 
+                                   outlet_loc = outlet_loc)
     
     # Find timestep (timestep is determined from UH_BOX input file)
     INPUT_INTERVAL = find_TS(uh_t,verbose)
     T_Cell = CELL_FLOWTIME*DAY_SECONDS/INPUT_INTERVAL
     T_UH = BASIN_FLOWTIME*DAY_SECONDS/INPUT_INTERVAL
     
-    # Read direction grid and find to_col (to_x) and to_row (to_y)
-    to_y, to_x = read_direction(Basin['Flow_Direction'], Basin['Basin_ID'],
-                                dy, dx, basin_id, NODATA, verbose)
-    
-    # Find row/column indicies of lat/lon inputs
-    x_ind = find_nearest(Basin['lon'], basin_x)
-    y_ind = find_nearest(Basin['lat'], basin_y)
+    # Find row/column indicies of the outlet in the subset
+    y_ind, x_ind = map(int, global_to_local(Basin, *Basin['outlet_loc']))
+
+    if network:
+        # Take to_y/to_x and the catchment from the stored flow network
+        to_y, to_x = network_direction(network, Basin, verbose)
+        Catchment, fractions = network_catchment(network, Basin, y_ind, x_ind,
+                                                 basin_id, verbose)
+    else:
+        # Read direction grid and find to_col (to_x) and to_row (to_y)
+        to_y, to_x = read_direction(Basin['Flow_Direction'], Basin['Basin_ID'],
+                                    dy, dx, basin_id, NODATA, verbose)
     
-    # Find all grid cells upstream of pour point
-    Catchment, fractions = search_catchment(to_y, to_x, y_ind, x_ind,
-                                            Basin['Basin_ID'], basin_id, 
-                                            verbose)
+        # Find all grid cells upstream of pour point
+        Catchment, fractions = search_catchment(to_y, to_x, y_ind, x_ind,
+                                                Basin['Basin_ID'], basin_id, 
+                                                verbose)
     
     # Make UH for each grid cell upstream of basin pour point 
     # (linear routing model - Saint-Venant equation)
@@ -81,48 +195,128 @@ def rout(infile, UHfile, basin_y, basin_x, velocity, diffusion, verbose,
     UH_out = aggregate(UH_S, T_UH, INPUT_INTERVAL, OUTPUT_INTERVAL,
                        Catchment['x_inds'], Catchment['y_inds'], NODATA, verbose)
     
-    #Write to output netcdf
-    time_steps = np.arange(UH_out.shape[0])
-    times = np.linspace(0, OUTPUT_INTERVAL*UH_out.shape[0], UH_out.shape[0],
-                        endpoint=False)
-    time_res = "%s seconds" % OUTPUT_INTERVAL
-    out_file = write_netcdf(basin_x, basin_y, Basin['lon'], Basin['lat'],
-                            times, time_steps, time_res, UH_out, fractions, 
-                            velocity, diffusion, basin_id, NODATA, verbose)
+    # Compact to the catchment cells
+    y_inds, x_inds = Catchment['y_inds'], Catchment['x_inds']
+    result = {}
+    result['uh'] = UH_out[:, y_inds, x_inds]
+    result['fraction'] = fractions[y_inds, x_inds]
+    result['yi'] = Basin['y_global'][y_inds, x_inds]
+    result['xi'] = Basin['x_global'][y_inds, x_inds]
+    if Basin['lat'].ndim == 1:
+        result['lats'] = Basin['lat'][y_inds]
+        result['lons'] = Basin['lon'][x_inds]
+    else:
+        result['lats'] = Basin['lat'][y_inds, x_inds]
+        result['lons'] = Basin['lon'][y_inds, x_inds]
+    result['y'] = Basin['y_global'][y_ind, x_ind]
+    result['x'] = Basin['x_global'][y_ind, x_ind]
+    result['lat'] = basin_y
+    result['lon'] = basin_x
+    result['basin_id'] = basin_id
+    result['velocity'] = velocity
+    result['diffusion'] = diffusion
+    result['time_step'] = np.arange(UH_out.shape[0])
+    result['time'] = np.linspace(0, OUTPUT_INTERVAL*UH_out.shape[0], 
+                                 UH_out.shape[0], endpoint=False)
+    result['time_res'] = "%s seconds" % OUTPUT_INTERVAL
+    result['timestep'] = OUTPUT_INTERVAL
+    result['grid'] = {'lons':Basin['lon'], 'lats':Basin['lat'], 
+                      'y_inds':y_inds, 'x_inds':x_inds}
+    return result
 
+def write_result(result, out_type, out_file, NODATA, verbose, 
+                 domain_file = None, subset = 0, threshold = 0, 
+                 param_writer = None):
+    """
+    Write one route_outlet (result) as a UH grid (out_type = grid, out_file 
+    is the output directory), or append it to a consolidated store (store) or
+    a RVIC parameter file (rvic_params, through the open (param_writer) of 
+    a run of outlets or one opened for this outlet only).  Returns the 
+    output file.
+    """
+    if out_type == 'store':
+        out_file = append_store(out_file, result['lon'], result['lat'], 
+                                result['basin_id'], result['lons'], 
+                                result['lats'], result['xi'], result['yi'],
+                                result['time'], result['time_step'], 
+                                result['time_res'], result['uh'], 
+                                result['fraction'], result['velocity'], 
+                                result['diffusion'], verbose)
+    elif out_type == 'rvic_params':
+        # Routing grid is the target grid, write the flattened RVIC layout
+        if param_writer is None:
+            writer = open_param_writer(out_file, domain_file)
+        else:
+            writer = param_writer
+        out_file = append_param_file(writer, result['lon'], result['lat'], 
+                                     result['x'], result['y'], result['xi'], 
+                                     result['yi'], result['uh'],
+                                     result['fraction'], result['timestep'], 
+                                     subset, threshold, verbose)
+        if param_writer is None:
+            close_param_writer(writer)
+    else:
+        # Rebuild the subset grids
+        grid = result['grid']
+        if grid['lats'].ndim == 1:
+            shape = (len(grid['lats']), len(grid['lons']))
+        else:
+            shape = grid['lats'].shape
+        UH_out = np.zeros((len(result['time']), )+shape)+NODATA
+        UH_out[:, grid['y_inds'], grid['x_inds']] = result['uh']
+        fractions = np.zeros(shape)
+        fractions[grid['y_inds'], grid['x_inds']] = result['fraction']
+        out_file = write_netcdf(result['lon'], result['lat'], grid['lons'], 
+                                grid['lats'], result['time'], 
+                                result['time_step'], result['time_res'], 
+                                UH_out, fractions, result['velocity'], 
+                                result['diffusion'], result['basin_id'], 
+                                NODATA, verbose, out_path = out_file or '')
     return out_file
     
 ##############################################################################
 ############### Routines #####################################################
 ##############################################################################
-def init(infile, basin_y, basin_x, velocity, diffusion, verbose):
+def init(infile, basin_y, basin_x, velocity, diffusion, verbose, domain = None,
+         outlet_loc = None):
     """
-    Handle the initial reading/clipping of input grids
+    Handle the initial reading/clipping of input grids.  If (domain) is given
+    (see read_domain), the grids are clipped from memory instead of (infile).
+    The outlet is snapped to the grid unless its global (y, x) index 
+    (outlet_loc) is given.  lat/lon may be 1-D (rectilinear) or 2-D.  An 
+    (infile) directory is read as ASCII rasters (see read_ascii_domain).
     """
+    if domain is None and os.path.isdir(infile):
+        domain = read_ascii_domain(infile, velocity, diffusion, verbose)
+    if domain is None:
+        f = Dataset(infile, 'r')
+        grids = f.variables
+    else:
+        grids = domain
     Inputs = {}
     vars = ['Basin_ID', 'lat', 'lon']
-    f = Dataset(infile, 'r')
     for var in vars:
-        Inputs[var] = f.variables[var][:]
+        Inputs[var] = grids[var][:]
     
     # Find Basin Dims and ID
     # Reads input lons/lats/basins_ids and returns basin bounds.
     if verbose:
         print 'Reading Global Inputs'
     
-    outlet_loc = (find_nearest(Inputs['lat'], basin_y), find_nearest(Inputs['lon'], basin_x))
+    if outlet_loc is None:
+        outlet_loc = snap_outlets(Inputs['lat'], Inputs['lon'], [basin_y], 
+                                  [basin_x], False)[0][2]
     basin_id = Inputs['Basin_ID'][outlet_loc]
     
     if verbose:
         print 'Input Latitude:', basin_y
         print 'Input Longitude:', basin_x
         print 'Input Basid ID:', basin_id
-    inds = np.nonzero(Inputs['Basin_ID'] == basin_id)
-    x,y = np.meshgrid(np.arange(len(Inputs['lon'])), np.arange(len(Inputs['lat'])))
-    x_min = min(x[inds])
-    x_max = max(x[inds])+1
-    y_min = min(y[inds])
-    y_max = max(y[inds])+1
+    y, x = np.nonzero(Inputs['Basin_ID'] == basin_id)
+    x_min = min(x)
+    x_max = max(x)+1
+    y_min = min(y)
+    y_max = max(y)+1
 
     # Load input arrays, store in python dictionary.  (Format -Basin['var'])
     vars = ['Basin_ID', 'Flow_Direction', 'Flow_Distance', 'lon', 'lat']
@@ -137,7 +331,7 @@ def init(infile, basin_y, basin_x, velocity, diffusion, verbose):
     Basin={}
     for var in vars:
         try:
-            temp = f.variables[var]
+            temp = grids[var]
         except NameError:
             print 'Unable to clip %s. Confirm that the var exists in %s' \
                     % (var, nc_str)
@@ -148,39 +342,212 @@ def init(infile, basin_y, basin_x, velocity, diffusion, verbose):
             Basin['lon'] = temp[x_min:x_max]
         elif var == 'lat':
             Basin['lat'] = temp[y_min:y_max]
+
+    # Keep the global (infile) index of every cell in the subset
+    Basin['y_global'], Basin['x_global'] = np.mgrid[y_min:y_max, x_min:x_max]
+    vars.extend(['y_global', 'x_global'])
+    Basin['outlet_loc'] = outlet_loc
     
     if velocity:
         Basin['Velocity'] = np.zeros((Basin['Flow_Direction'].shape))+velocity
     if diffusion:
         Basin['Diffusion'] = np.zeros((Basin['Flow_Direction'].shape))+diffusion
     
-    if 'VIC' in f.variables['Flow_Direction'].units:
-        # VIC Directions: http://www.hydro.washington.edu/Lettenmaier/Models/VIC/Documentation/Routing/FlowDirection.shtml
-        dy = {1:-1, 2:-1, 3:0, 4:1, 5:1, 6:1, 7:0, 8:-1}
-        dx = {1:0, 2:1, 3:1, 4:1, 5:0, 6:-1, 7:-1, 8:-1}
-        if verbose:
-            print 'Using VIC flow directions (1-8).'
+    if domain is None:
+        dy, dx = direction_offsets(f.variables['Flow_Direction'].units, verbose)
+        f.close()
     else:
-        # ARCMAP Directions: http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=flow_direction
-        dy = {1:0, 2:1, 4:1, 8:1, 16:0, 32:-1, 64:-1, 128:-1}
-        dx = {1:1, 2:1, 4:0, 8:-1, 16:-1, 32:-1, 64:0, 128:1}
-        if verbose:
-            print 'Using ARCMAP flow directions (1-128).'
-    
-    f.close()
+        dy, dx = direction_offsets(domain['direction_units'], verbose)
     if verbose:
         print 'grid cells in subset: %i' % Basin['Velocity'].size
 
     # Check latitude order, flip if necessary.
-    if Basin['lat'][-1]>Basin['lat'][0]:
+    if lat_ascending(Basin['lat']):
         if verbose:
             print 'Inputs came in upside down, flipping everything now.'
-        vars.remove('lon')
+        if Basin['lon'].ndim == 1:
+            vars.remove('lon')
         for var in vars:
             Basin[var] = np.flipud(Basin[var])
         
     return Basin, dy, dx, basin_id
 
+def read_domain(infile, velocity, diffusion, verbose, direction_units = None):
+    """
+    Read the full input grids into memory so that many outlets can be clipped
+    by init without touching (infile) again.  (direction_units) only 
+    applies to ASCII rasters (see read_ascii_domain).
+    """
+    if os.path.isdir(infile):
+        return read_ascii_domain(infile, velocity, diffusion, verbose, 
+                                 direction_units = direction_units)
+    if verbose:
+        print 'Reading full domain from %s' % infile
+    vars = ['Basin_ID', 'Flow_Direction', 'Flow_Distance', 'lon', 'lat']
+    if not velocity:
+        vars.append('velocity')
+    if not diffusion:
+        vars.append('diffusion')
+    domain = {}
+    f = Dataset(infile, 'r')
+    for var in vars:
+        domain[var] = f.variables[var][:]
+    domain['direction_units'] = f.variables['Flow_Direction'].units
+    f.close()
+    return domain
+
+def read_ascii_domain(in_dir, velocity, diffusion, verbose, 
+                      direction_units = None):
+    """
+    Read the input grids from the ArcInfo ASCII rasters in (in_dir), named 
+    after the netCDF variables (Basin_ID.asc, Flow_Direction.asc, 
+    Flow_Distance.asc and optionally velocity.asc, diffusion.asc).  Returns 
+    the same dictionary as read_domain, the grids are memory mapped from 
+    their binary cache.  Flow direction units are (direction_units) if 
+    given, else VIC (1-8) unless codes greater than 8 (ARCMAP, 1-128) are 
+    found outside the NODATA_value cells.  A warning is printed if all the 
+    codes are valid in both (1, 2, 4 and 8 only).
+    """
+    if verbose:
+        print 'Reading ASCII domain from %s' % in_dir
+    vars = ['Flow_Direction', 'Basin_ID', 'Flow_Distance']
+    if not velocity:
+        vars.append('velocity')
+    if not diffusion:
+        vars.append('diffusion')
+    domain = {}
+    nodata = {}
+    for var in vars:
+        if var in ['Basin_ID', 'Flow_Direction']:
+            dtype = np.int32
+        else:
+            dtype = np.float64
+        domain[var], header = read_ascii_grid(os.path.join(in_dir, var+'.asc'),
+                                              dtype, verbose)
+        # each grid may have its own NODATA_value
+        nodata[var] = header.pop('nodata_value', None)
+        if var == 'Flow_Direction':
+            grid_header = header
+        elif header != grid_header:
+            raise ValueError('%s.asc does not match the Flow_Direction.asc '
+                             'grid' % var)
+
+    # cell centers, ASCII rasters are stored north to south
+    ncols, nrows = grid_header['ncols'], grid_header['nrows']
+    size = grid_header['cellsize']
+    if 'xllcorner' in grid_header:
+        x0 = grid_header['xllcorner'] + size/2.
+        y0 = grid_header['yllcorner'] + size/2.
+    else:
+        x0 = grid_header['xllcenter']
+        y0 = grid_header['yllcenter']
+    domain['lon'] = x0 + size*np.arange(ncols)
+    domain['lat'] = y0 + size*np.arange(nrows-1, -1, -1)
+
+    if direction_units:
+        domain['direction_units'] = direction_units
+        return domain
+    directions = domain['Flow_Direction']
+    if nodata['Flow_Direction'] is not None:
+        directions = directions[directions != nodata['Flow_Direction']]
+    codes = np.unique(directions[directions > 0])
+    if codes.size and codes.max() > 8:
+        domain['direction_units'] = 'ARCMAP'
+    else:
+        domain['direction_units'] = 'VIC'
+        if codes.size and np.in1d(codes, [1, 2, 4, 8]).all():
+            print 'WARNING: Flow_Direction.asc codes %s are valid VIC and ' \
+                  'ARCMAP directions, read as VIC (set direction_units to ' \
+                  'override)' % list(codes)
+    return domain
+
+def read_ascii_grid(asc_file, dtype, verbose):
+    """
+    Returns the data of an ArcInfo ASCII raster (asc_file) as a read only 
+    memory map of (dtype) and its header (dictionary).  The raster is parsed once and 
+    cached next to it as a .npy file, which is reused until the raster is 
+    modified.
+    """
+    with open(asc_file, 'r') as f:
+        header = read_ascii_header(f)
+        cache = os.path.splitext(asc_file)[0]+'.npy'
+        if (os.path.exists(cache) and 
+            os.path.getmtime(cache) >= os.path.getmtime(asc_file)):
+            if verbose:
+                print 'Loading cached %s' % cache
+            return np.load(cache, mmap_mode='r'), header
+
+        if verbose:
+            print 'Parsing %s' % asc_file
+        start = tm.time()
+        data = np.fromstring(f.read(), sep=' ')
+    if data.size != header['nrows']*header['ncols']:
+        raise ValueError('%s has %i values for a %i x %i grid' 
+                         % (asc_file, data.size, header['nrows'], 
+                            header['ncols']))
+    data = data.reshape(header['nrows'], header['ncols']).astype(dtype)
+    if verbose:
+        print 'Parsed %i values in %.2f seconds' % (data.size, tm.time()-start)
+
+    # write to a temporary file first so a partial cache is never read
+    try:
+        with open(cache+'.tmp', 'wb') as f:
+            np.save(f, data)
+        os.rename(cache+'.tmp', cache)
+    except (IOError, OSError):
+        print 'WARNING: unable to cache %s to %s' % (asc_file, cache)
+        return data, header
+    return np.load(cache, mmap_mode='r'), header
+
+def input_mtime(infile):
+    """
+    Modification time of (infile), or of the newest ASCII raster if (infile)
+    is a directory (the directory itself changes as rasters are cached).
+    """
+    if os.path.isdir(infile):
+        return max(os.path.getmtime(os.path.join(infile, name)) 
+                   for name in os.listdir(infile) if name.endswith('.asc'))
+    return os.path.getmtime(infile)
+
+def read_ascii_header(f):
+    """
+    Read the header lines of an ArcInfo ASCII raster from the open file (f),
+    leaving (f) at the first data value.  Keys are lower case.
+    """
+    header = {}
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        key = line.split()[0].lower() if line.strip() else ''
+        if not key or key[0] in '-+.0123456789':
+            f.seek(pos)
+            break
+        value = line.split()[1]
+        if key in ['ncols', 'nrows']:
+            header[key] = int(value)
+        else:
+            header[key] = float(value)
+    return header
+
+def direction_offsets(units, verbose):
+    """
+    Returns the (dy, dx) dictionaries for the flow direction convention given
+    by the Flow_Direction (units).  dy is positive towards the south.
+    """
+    if 'VIC' in units:
+        # VIC Directions: http://www.hydro.washington.edu/Lettenmaier/Models/VIC/Documentation/Routing/FlowDirection.shtml
+        dy = {1:-1, 2:-1, 3:0, 4:1, 5:1, 6:1, 7:0, 8:-1}
+        dx = {1:0, 2:1, 3:1, 4:1, 5:0, 6:-1, 7:-1, 8:-1}
+        if verbose:
+            print 'Using VIC flow directions (1-8).'
+    else:
+        # ARCMAP Directions: http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=flow_direction
+        dy = {1:0, 2:1, 4:1, 8:1, 16:0, 32:-1, 64:-1, 128:-1}
+        dx = {1:1, 2:1, 4:0, 8:-1, 16:-1, 32:-1, 64:0, 128:1}
+        if verbose:
+            print 'Using ARCMAP flow directions (1-128).'
+    return dy, dx
+
 def process_command_line(config_file = None):
     """
     Parse arguments and assign flags for further loading of variables, for
@@ -193,7 +560,8 @@ def process_command_line(config_file = None):
     parser.add_argument("-C", "--configFile", type = str, 
         help = "Input configuration file", default = False)
     parser.add_argument("-i", "--infile", type = str, 
-        help = "Input netCDF containing all input grids")
+        help = "Input netCDF containing all input grids, or directory of "
+        "ASCII rasters (Basin_ID.asc, Flow_Direction.asc, Flow_Distance.asc)")
     parser.add_argument("-UH", "--UHfile", type = str, 
         help = "Input UH_BOX hydrograph")
     parser.add_argument("-lon", "--longitude", type = float, nargs = '*',
@@ -220,6 +588,37 @@ def process_command_line(config_file = None):
         help = "Output timestep in seconds for Unit Hydrographs")
     parser.add_argument("--DAY_SECONDS", type = int,default = 86400,
         help = "Seconds per day")
+    parser.add_argument("--out_type", type = str, default = 'grid',
+        choices = ['grid', 'store', 'rvic_params'],
+        help = "Write one UH grid per outlet (grid), append all outlets to "
+        "a single consolidated store (store) or to a RVIC parameter file "
+        "(rvic_params)")
+    parser.add_argument("-o", "--out_file", type = str, 
+        help = "Output directory (out_type = grid) or output store/parameter "
+        "file (out_type = store/rvic_params)")
+    parser.add_argument("--domain_file", type = str, 
+        help = "Target grid domain file, must match the routing grid "
+        "(out_type = rvic_params)")
+    parser.add_argument("--subset", type = int, default = 0,
+        help = "Number of timesteps to keep of each UH after first point > "
+        "threshold (out_type = rvic_params)")
+    parser.add_argument("--threshold", type = float, default = 0,
+        help = "Threshold to use to subset the unit hydrograph")
+    parser.add_argument("--upscale", action = "store_true",
+        help = "Route on the domain_file grid (xc, yc, mask, area) with a "
+        "flow network upscaled from infile")
+    parser.add_argument("--direction_units", type = str, 
+        choices = ['VIC', 'ARCMAP'],
+        help = "Flow direction units of ASCII raster inputs, overrides the "
+        "guess from the codes (VIC 1-8 unless codes above 8 are found)")
+    parser.add_argument("--network", type = str, 
+        help = "Flow network directory, made from infile on first use")
+    parser.add_argument("--serve", type = str, 
+        help = "Run as a routing service on localhost:port or a Unix socket "
+        "path instead of routing to lon/lat")
+    parser.add_argument("--workers", type = int, 
+        default = multiprocessing.cpu_count(),
+        help = "Number of worker processes of the routing service")
     args = parser.parse_args()
 
     # Assign values
@@ -245,7 +644,7 @@ def process_command_line(config_file = None):
             raise IOError('Need input Unit Hydrograph File from command line ' 
                 'or configuration file')
 
-    if args.longitude:
+    if args.longitude or args.serve:
         Plons = args.longitude
     else:
         try:
@@ -254,7 +653,7 @@ def process_command_line(config_file = None):
             raise IOError('Need logitude(s) from command line or '
                 'configuration file')
         
-    if args.latitude:
+    if args.latitude or args.serve:
         Plats = args.latitude
     else:
         try:
@@ -315,10 +714,72 @@ def process_command_line(config_file = None):
         DAY_SECONDS = int(inputs['day_seconds'])
     except:
         DAY_SECONDS = args.DAY_SECONDS
+
+    try:
+        out_type = inputs['out_type']
+    except:
+        out_type = args.out_type
+
+    if args.out_file:
+        out_file = args.out_file
+    else:
+        try:
+            out_file = file_paths['out_file']
+        except:
+            out_file = None
+    if out_type in ['store', 'rvic_params'] and not out_file:
+        raise IOError('Need out_file from command line or configuration '
+            'file when out_type is %s' % out_type)
+
+    if args.domain_file:
+        domain_file = args.domain_file
+    else:
+        try:
+            domain_file = file_paths['domain_file']
+        except:
+            domain_file = None
+    try:
+        if inputs['upscale'] == 'True':
+            upscale = True
+        else:
+            upscale = False
+    except:
+        upscale = args.upscale
+
+    if (out_type == 'rvic_params' or upscale) and not domain_file:
+        raise IOError('Need domain_file from command line or configuration '
+            'file when out_type is rvic_params or upscale is set')
+
+    try:
+        subset = int(inputs['subset'])
+    except:
+        subset = args.subset
+
+    try:
+        threshold = float(inputs['threshold'])
+    except:
+        threshold = args.threshold
+
+    try:
+        direction_units = inputs['direction_units']
+    except:
+        direction_units = args.direction_units
+    if direction_units not in [None, 'VIC', 'ARCMAP']:
+        raise ValueError('direction_units must be VIC or ARCMAP, not %s' 
+                         % direction_units)
+
+    if args.network:
+        network_file = args.network
+    else:
+        try:
+            network_file = file_paths['network']
+        except:
+            network_file = None
         
     return (infile, UHfile, Plons, Plats, velocity, diffusion, verbose, 
             NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, 
-            DAY_SECONDS)
+            DAY_SECONDS, out_type, out_file, domain_file, subset, threshold,
+            network_file, args.serve, args.workers, upscale, direction_units)
 
 ##############################################################################
 ##  Process Configuration File
@@ -413,6 +874,69 @@ def find_nearest(array, value):
     idx = (np.abs(array-value)).argmin()
     return idx
 
+def nearest_1d(array, values):
+    """
+    Vectorized find_nearest, the index locations in (array) nearest to each
+    of (values).  Ties go to the lowest index, as with find_nearest, for 
+    ascending or descending (array).
+    """
+    order = np.argsort(array, kind='mergesort')
+    sorted_array = array[order]
+    right = np.clip(np.searchsorted(sorted_array, values), 1, len(array)-1)
+    # first (lowest index) of the equal values left of right
+    left = np.searchsorted(sorted_array, sorted_array[right - 1])
+    right_dist = np.abs(sorted_array[right]-values)
+    left_dist = np.abs(sorted_array[left]-values)
+    use_right = ((right_dist < left_dist) | 
+                 ((right_dist == left_dist) & (order[right] < order[left])))
+    return order[np.where(use_right, right, left)]
+
+def snap_outlets(lats, lons, Plats, Plons, verbose):
+    """
+    Snap all outlets (Plats, Plons) to the grid in one pass.  1-D lat/lon 
+    (rectilinear) are snapped along each axis as find_nearest does.  2-D 
+    lat/lon (curvilinear) are snapped with a KD-tree of the cell centers on
+    the unit sphere, built once.  Outlets that land in the same cell are only
+    kept once.  Returns a list of (lat, lon, (y, x)) in input order.
+    """
+    Plats = np.asarray(Plats, dtype=float)
+    Plons = np.asarray(Plons, dtype=float)
+    if lats.ndim == 1:
+        y = nearest_1d(lats, Plats)
+        x = nearest_1d(lons, Plons)
+        cells = y*len(lons) + x
+        shape = (len(lats), len(lons))
+    else:
+        tree = cKDTree(sphere_xyz(lats.ravel(), lons.ravel()))
+        dist, cells = tree.query(sphere_xyz(Plats, Plons))
+        shape = lats.shape
+    first = np.sort(np.unique(cells, return_index=True)[1])
+    if verbose and len(first) < len(Plats):
+        print 'Routing to %i unique cells for %i outlets' % (len(first), 
+                                                             len(Plats))
+    outlets = []
+    for i in first:
+        y, x = np.unravel_index(cells[i], shape)
+        outlets.append((Plats[i], Plons[i], (int(y), int(x))))
+    return outlets
+
+def sphere_xyz(lats, lons):
+    """
+    Cartesian coordinates of (lats, lons) on the unit sphere.
+    """
+    lats = np.deg2rad(lats)
+    lons = np.deg2rad(lons)
+    return np.column_stack((np.cos(lats)*np.cos(lons), 
+                            np.cos(lats)*np.sin(lons), np.sin(lats)))
+
+def lat_ascending(lat):
+    """
+    True if the rows of (lat) (1-D or 2-D) run from south to north.
+    """
+    if lat.ndim == 1:
+        return lat[-1] > lat[0]
+    return lat[-1].mean() > lat[0].mean()
+
 ##############################################################################
 ## Seach Catchment
 ## Find all cells upstream of pour point.  Retrun a dictionary with x_inds, yinds,
@@ -465,6 +989,410 @@ def search_catchment(to_y, to_x, y_ind, x_ind, basin_ids, basin_id, verbose):
 
     return (CATCH, fractions)
 
+##############################################################################
+## Flow Network
+## One-time preprocessing of the full infile grid into a directory of
+## memory-mappable arrays (.npy).  Cells are numbered by their flat index in
+## the infile grid, -1 means no downstream cell.
+##   downstream - downstream cell of every cell
+##   up_ptr, up_ind - CSR upstream adjacency, the upstream cells of cell (i)
+##                    are up_ind[up_ptr[i]:up_ptr[i+1]]
+##   topo_order - cells ordered from the pour points upstream (every cell
+##                comes after its downstream cell)
+##   count_ds, dist_ds - cells and Flow_Distance to the pour point
+##   pour_point - flat index of the pour point (basin membership)
+##   basin_id - Basin_ID of every cell
+##############################################################################
+network_vars = ['downstream', 'up_ptr', 'up_ind', 'topo_order', 'count_ds', 
+                'dist_ds', 'pour_point', 'basin_id']
+
+def make_network(infile, network_file, verbose, domain = None, 
+                 domain_file = None):
+    """
+    Build the flow network of the full (infile) grid, or of (domain) if 
+    given, and save it to the directory (network_file).  (domain_file) is 
+    the target grid (domain) was upscaled to, if it was.
+    """
+    if verbose:
+        print 'Making flow network from %s' % infile
+    if domain is None:
+        grids = read_domain(infile, True, True, verbose)
+    else:
+        grids = domain
+    fdr = np.ma.filled(grids['Flow_Direction'][:], -1).astype(int)
+    dist = np.ma.filled(grids['Flow_Distance'][:], 0.)
+    basin_ids = np.ma.filled(grids['Basin_ID'][:], -1)
+    lat = grids['lat']
+    dy, dx = direction_offsets(grids['direction_units'], verbose)
+
+    network = flow_network(fdr, dist, basin_ids, dy, dx, lat_ascending(lat),
+                           wrap = domain_file is not None and 
+                                  lon_periodic(grids['lon']))
+    if verbose:
+        print 'Flow network has %i cells and %i pour points' \
+                % (fdr.size, len(np.unique(network['pour_point'])))
+
+    os.makedirs(network_file)
+    for var in network_vars:
+        np.save(os.path.join(network_file, var+'.npy'), network[var])
+    config = ConfigParser.ConfigParser()
+    config.add_section('network')
+    config.set('network', 'infile', os.path.abspath(infile))
+    config.set('network', 'mtime', repr(input_mtime(infile)))
+    config.set('network', 'shape', ', '.join(map(str, fdr.shape)))
+    config.set('network', 'upscale', str(domain_file is not None))
+    if domain_file is not None:
+        config.set('network', 'domain_file', os.path.abspath(domain_file))
+        config.set('network', 'domain_mtime', 
+                   repr(os.path.getmtime(domain_file)))
+    config.set('network', 'created', tm.ctime(tm.time()))
+    with open(os.path.join(network_file, 'network.cfg'), 'wb') as configfile:
+        config.write(configfile)
+    return network_file
+
+def flow_network(fdr, dist, basin_ids, dy, dx, flipped, wrap = False):
+    """
+    Vectorized construction of the flow network arrays from the direction
+    grid (fdr).  (flipped) is True if the grids are stored south to north, 
+    (wrap) if the columns wrap around in longitude.
+    """
+    ny, nx = fdr.shape
+    size = ny*nx
+    codes = max(dy.keys())+1
+    dy_table = np.zeros(codes, dtype=int)
+    dx_table = np.zeros(codes, dtype=int)
+    valid_table = np.zeros(codes, dtype=bool)
+    for d in dy:
+        dy_table[d], dx_table[d], valid_table[d] = dy[d], dx[d], True
+    if flipped:
+        dy_table *= -1
+
+    y, x = np.mgrid[0:ny, 0:nx]
+    valid = (fdr >= 0)*(fdr < codes)
+    valid[valid] = valid_table[fdr[valid]]
+    code = np.where(valid, fdr, 0)
+    to_y = y + dy_table[code]
+    to_x = x + dx_table[code]
+    if wrap:
+        to_x %= nx
+    valid *= (to_y >= 0)*(to_y < ny)*(to_x >= 0)*(to_x < nx)
+    downstream = np.where(valid, to_y*nx + to_x, -1).ravel()
+
+    # CSR upstream adjacency
+    cells = np.nonzero(downstream >= 0)[0]
+    order = np.argsort(downstream[cells], kind='mergesort')
+    up_ind = cells[order]
+    up_ptr = np.zeros(size+1, dtype=int)
+    up_ptr[1:] = np.cumsum(np.bincount(downstream[cells], minlength=size))
+
+    # Walk upstream from the pour points one level at a time
+    count_ds = np.zeros(size, dtype=int) - 1
+    dist_ds = np.zeros(size)
+    pour_point = np.zeros(size, dtype=int) - 1
+    frontier = np.nonzero(downstream < 0)[0]
+    count_ds[frontier] = 0
+    pour_point[frontier] = frontier
+    levels = [frontier]
+    flat_dist = dist.ravel()
+    while len(frontier):
+        frontier, parents = upstream_cells(up_ptr, up_ind, frontier)
+        count_ds[frontier] = count_ds[parents] + 1
+        dist_ds[frontier] = dist_ds[parents] + flat_dist[frontier]
+        pour_point[frontier] = pour_point[parents]
+        levels.append(frontier)
+
+    network = {}
+    network['downstream'] = downstream
+    network['up_ptr'] = up_ptr
+    network['up_ind'] = up_ind
+    network['topo_order'] = np.concatenate(levels)
+    network['count_ds'] = count_ds
+    network['dist_ds'] = dist_ds
+    network['pour_point'] = pour_point
+    network['basin_id'] = basin_ids.ravel()
+    network['shape'] = fdr.shape
+    return network
+
+def upstream_cells(up_ptr, up_ind, cells):
+    """
+    Returns all cells directly upstream of (cells) and, for each of them, the
+    cell in (cells) they flow into.
+    """
+    counts = up_ptr[cells+1] - up_ptr[cells]
+    parents = np.repeat(cells, counts)
+    starts = np.repeat(up_ptr[cells] - np.cumsum(counts) + counts, counts)
+    upstream = up_ind[starts + np.arange(counts.sum())]
+    return upstream, parents
+
+##############################################################################
+##  Upscaled Flow Network
+##  Route directly on the coarse target (domain_file) grid.  Every fine cell
+##  belongs to the target cell with the nearest center, the outlet of a 
+##  target cell is its fine cell with the most upstream cells and a target 
+##  cell drains to the target cell the fine flow path from its outlet enters.
+##  Flow_Distance is the fine path length from the outlet to the downstream 
+##  target cell outlet (or to where the path leaves that cell).
+##############################################################################
+def upscale_domain(infile, domain_file, velocity, diffusion, verbose, 
+                   direction_units = None):
+    """
+    Upscale the (infile) grids to the (domain_file) grid (xc, yc, mask and 
+    area).  Returns a domain dictionary (see read_domain) on the target grid
+    with VIC flow directions, Basin_ID is the flat index of the pour point 
+    plus one (-1 where no land).
+    """
+    fine = read_domain(infile, velocity, diffusion, verbose, 
+                       direction_units = direction_units)
+    f = Dataset(domain_file, 'r')
+    yc = f.variables['yc'][:]
+    xc = f.variables['xc'][:]
+    mask = f.variables['mask'][:]
+    area = f.variables['area'][:]
+    f.close()
+    if verbose:
+        print 'Upscaling flow network of %s to %s' % (infile, domain_file)
+
+    fdr = np.ma.filled(fine['Flow_Direction'][:], -1).astype(int)
+    dist = np.ma.filled(fine['Flow_Distance'][:], 0.).ravel()
+    basin_ids = np.ma.filled(fine['Basin_ID'][:], -1)
+    dy, dx = direction_offsets(fine['direction_units'], False)
+    network = flow_network(fdr, dist.reshape(fdr.shape), basin_ids, dy, dx,
+                           lat_ascending(fine['lat']))
+    downstream = network['downstream']
+
+    # target cell of every fine land cell, cells in loops are left out
+    lats, lons = fine['lat'], fine['lon']
+    if lats.ndim == 1:
+        lons, lats = np.meshgrid(lons, lats)
+    target = target_cells(yc, xc, mask, lats, lons)
+    target[(basin_ids.ravel() < 0) | (network['count_ds'] < 0)] = -1
+
+    # outlet of every target cell
+    acc = flow_accumulation(network)
+    cells = np.nonzero(target >= 0)[0]
+    order = np.lexsort((acc[cells], target[cells]))
+    sorted_targets = target[cells][order]
+    last = np.append(sorted_targets[1:] != sorted_targets[:-1], True)
+    outlets = cells[order][last]
+    outlet_targets = sorted_targets[last]
+    outlet_of = np.zeros(yc.size, dtype=int) - 1
+    outlet_of[outlet_targets] = outlets
+
+    # follow the fine path out of each target cell
+    down = np.zeros(len(outlets), dtype=int) - 1
+    length = np.zeros(len(outlets))
+    cur = outlets.copy()
+    active = np.arange(len(outlets))
+    while len(active):
+        length[active] += dist[cur[active]]
+        nxt = downstream[cur[active]]
+        nxt_target = np.where(nxt < 0, -1, target[nxt])
+        left = nxt_target != outlet_targets[active]
+        down[active[left]] = nxt_target[left]
+        cur[active] = nxt
+        active = active[~left & (nxt >= 0)]
+
+    # and on to the downstream target cell outlet
+    active = np.nonzero(down >= 0)[0]
+    while len(active):
+        active = active[(cur[active] != outlet_of[down[active]]) & 
+                        (cur[active] >= 0)]
+        active = active[target[cur[active]] == down[active]]
+        length[active] += dist[cur[active]]
+        cur[active] = downstream[cur[active]]
+
+    # velocity/diffusion grids are taken at the outlets
+    domain = {}
+    for var in ['velocity', 'diffusion']:
+        if var in fine:
+            grid = np.zeros(yc.size)
+            grid[outlet_targets] = np.ma.filled(fine[var][:], 0.).ravel()[outlets]
+            domain[var] = grid.reshape(yc.shape)
+
+    # VIC flow directions, dy is positive towards the south
+    vic_dy, vic_dx = direction_offsets('VIC', False)
+    codes = np.zeros((3, 3), dtype=int)
+    for d in vic_dy:
+        codes[vic_dy[d]+1, vic_dx[d]+1] = d
+    y, x = np.unravel_index(outlet_targets, yc.shape)
+    to_y, to_x = np.unravel_index(np.maximum(down, 0), yc.shape)
+    step_y = np.clip(to_y - y, -1, 1)
+    if lat_ascending(yc):
+        step_y *= -1
+    step_x = to_x - x
+    wrap = lon_periodic(xc)
+    if wrap:
+        # shortest way around, the outlet may drain across the date line
+        step_x = (step_x + yc.shape[-1]//2) % yc.shape[-1] - yc.shape[-1]//2
+    step_x = np.clip(step_x, -1, 1)
+    fdr = np.zeros(yc.size, dtype=int) - 1
+    fdr[outlet_targets] = np.where(down >= 0, codes[step_y+1, step_x+1], 0)
+    distance = np.zeros(yc.size)
+    distance[outlet_targets] = length
+
+    # basins of the upscaled network
+    fdr = fdr.reshape(yc.shape)
+    network = flow_network(fdr, distance.reshape(yc.shape), 
+                           np.zeros(yc.shape), vic_dy, vic_dx, 
+                           lat_ascending(yc), wrap = wrap)
+    basin = np.where(fdr.ravel() >= 0, network['pour_point'] + 1, -1)
+    if verbose:
+        print 'Upscaled %i fine cells to %i target cells in %i basins' \
+                % (len(cells), len(outlets), 
+                   len(np.unique(basin[basin > 0])))
+
+    domain['Basin_ID'] = basin.reshape(yc.shape)
+    domain['Flow_Direction'] = fdr
+    domain['Flow_Distance'] = distance.reshape(yc.shape)
+    domain['lat'] = yc
+    domain['lon'] = xc
+    domain['area'] = area
+    domain['direction_units'] = 'VIC'
+    return domain
+
+def lon_periodic(lon):
+    """
+    True if the columns of (lon) (1-D or 2-D) go all the way around the 
+    globe.
+    """
+    lon = np.ma.filled(lon, np.nan)
+    if lon.ndim > 1:
+        lon = lon[0]
+    if len(lon) < 2:
+        return False
+    spacing = np.abs(np.median(np.diff(lon)))
+    return bool(np.isclose(len(lon)*spacing, 360.))
+
+def target_cells(yc, xc, mask, lats, lons):
+    """
+    Flat index of the (yc, xc) cell with the nearest center to every (lats,
+    lons) cell, -1 if that cell is masked or further than half the diagonal
+    of the target grid spacing.
+    """
+    tree = cKDTree(sphere_xyz(yc.ravel(), xc.ravel()))
+    spacing = tree.query(tree.data, k=2)[0][:, 1]
+    dist, target = tree.query(sphere_xyz(lats.ravel(), lons.ravel()))
+    outside = (dist > spacing[target]*np.sqrt(0.5)) | (mask.ravel()[target] <= 0)
+    target[outside] = -1
+    return target
+
+def flow_accumulation(network):
+    """
+    Number of cells upstream of (and including) every cell of (network).
+    """
+    acc = np.ones(len(network['downstream']), dtype=int)
+    cells = network['topo_order']
+    levels = network['count_ds'][cells]
+    bounds = np.searchsorted(levels, np.arange(levels[-1]+2))
+    for level in xrange(levels[-1], 0, -1):
+        level_cells = cells[bounds[level]:bounds[level+1]]
+        np.add.at(acc, network['downstream'][level_cells], acc[level_cells])
+    return acc
+
+def load_network(network_file, infile, verbose, domain_file = None):
+    """
+    Memory map the flow network in (network_file).  Warns if it was made from
+    a different or since modified (infile) or (domain_file), raises 
+    ValueError if it was (not) upscaled to (domain_file).
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(network_file, 'network.cfg'))
+    if (config.get('network', 'infile') != os.path.abspath(infile) or 
+        float(config.get('network', 'mtime')) != input_mtime(infile)):
+        print 'WARNING: flow network %s was not made from the current %s' \
+                % (network_file, infile)
+    try:
+        upscaled = config.getboolean('network', 'upscale')
+    except ConfigParser.NoOptionError:
+        upscaled = False
+    if upscaled != (domain_file is not None):
+        raise ValueError('flow network %s was%s upscaled, remove it or use '
+                         'another network directory' 
+                         % (network_file, '' if upscaled else ' not'))
+    if domain_file is not None:
+        if config.get('network', 'domain_file') != os.path.abspath(domain_file):
+            raise ValueError('flow network %s was upscaled to %s, not %s' 
+                             % (network_file, 
+                                config.get('network', 'domain_file'), 
+                                domain_file))
+        if (float(config.get('network', 'domain_mtime')) != 
+            os.path.getmtime(domain_file)):
+            print 'WARNING: flow network %s was not made from the current %s' \
+                    % (network_file, domain_file)
+    if verbose:
+        print 'Loading flow network: %s' % network_file
+    network = {}
+    for var in network_vars:
+        network[var] = np.load(os.path.join(network_file, var+'.npy'),
+                               mmap_mode='r')
+    network['shape'] = tuple(map(int, config.get('network', 'shape').split(',')))
+    return network
+
+def global_to_local(Basin, y, x):
+    """
+    Converts global (infile) indices to indices in the (possibly flipped) 
+    Basin subset.  Cells outside of the subset get -9999.
+    """
+    y_global, x_global = Basin['y_global'], Basin['x_global']
+    if y_global[0, 0] > y_global[-1, 0]:
+        yy = y_global[0, 0] - y
+    else:
+        yy = y - y_global[0, 0]
+    xx = x - x_global[0, 0]
+    outside = (yy < 0)+(yy >= y_global.shape[0])+(xx < 0)+(xx >= y_global.shape[1])
+    return np.where(outside, -9999, yy), np.where(outside, -9999, xx)
+
+def network_direction(network, Basin, verbose):
+    """
+    Makes (to_y) and (to_x) for the Basin subset from the flow network, the
+    same grids read_direction makes from Flow_Direction.
+    """
+    if verbose:
+        print 'Finding target row/columns from flow network'
+    nx = network['shape'][1]
+    cells = Basin['y_global']*nx + Basin['x_global']
+    downstream = network['downstream'][cells.ravel()].reshape(cells.shape)
+    to_y, to_x = global_to_local(Basin, downstream // nx, downstream % nx)
+    to_y[downstream < 0] = -9999
+    to_x[downstream < 0] = -9999
+    return to_y, to_x
+
+def network_catchment(network, Basin, y_ind, x_ind, basin_id, verbose):
+    """
+    Find all cells upstream of pour point by walking the upstream adjacency
+    of the flow network.  Returns the same (CATCH, fractions) as 
+    search_catchment.
+    """
+    if verbose:
+        print 'Searching Catchment in flow network'
+    nx = network['shape'][1]
+    outlet = Basin['y_global'][y_ind, x_ind]*nx + Basin['x_global'][y_ind, x_ind]
+    levels = [np.array([outlet])]
+    while len(levels[-1]):
+        levels.append(upstream_cells(network['up_ptr'], network['up_ind'],
+                                     levels[-1])[0])
+    cells = np.concatenate(levels)
+    cells = cells[network['basin_id'][cells] == basin_id]
+    y, x = global_to_local(Basin, cells // nx, cells % nx)
+    count_ds = network['count_ds'][cells] - network['count_ds'][outlet]
+
+    # same ordering as search_catchment
+    CATCH = {}
+    ii = np.lexsort((x, y))
+    CATCH['x_inds'] = x[ii]
+    CATCH['y_inds'] = y[ii]
+    CATCH['count_ds'] = count_ds[ii]
+    ii = np.argsort(CATCH['count_ds'])
+    CATCH['count_ds'] = CATCH['count_ds'][ii]
+    CATCH['x_inds'] = CATCH['x_inds'][ii]
+    CATCH['y_inds'] = CATCH['y_inds'][ii]
+    if verbose:
+        print "Upstream grid cells from present station: %i" % len(cells)
+
+    fractions = np.zeros(Basin['y_global'].shape)
+    fractions[CATCH['y_inds'], CATCH['x_inds']] = 1.
+    return (CATCH, fractions)
+
 ##############################################################################
 ##  MakeUH
 ##  Calculate impulse response function for grid cells using equation (15) 
@@ -595,27 +1523,36 @@ def aggregate(UH_S, T_UH, INPUT_INTERVAL, OUTPUT_INTERVAL, x_inds, y_inds,
 ##  Writes out a netCDF3-64BIT data file containing the UH_S and fractions
 ##############################################################################
 def write_netcdf(basin_x, basin_y, lons, lats, times, time_steps, time_res, UH_S, 
-                 fractions, velocity, diffusion, basin_id, NODATA, verbose):
+                 fractions, velocity, diffusion, basin_id, NODATA, verbose,
+                 out_path = ''):
     """
     Write output to netCDF.  Writes out a netCDF4 data file containing the
-    UH_S and fractions.
+    UH_S and fractions in directory (out_path).
     """
-    string = 'UH_%.3f_%.3f.nc' % (basin_x, basin_y)
+    string = os.path.join(out_path, 'UH_%.3f_%.3f.nc' % (basin_x, basin_y))
     f = Dataset(string,'w', format = 'NETCDF4')
 
-    # set dimensions
+    # set dimensions (curvilinear grids get y/x dims and 2d lat/lon)
     time = f.createDimension('time', None)
-    lon = f.createDimension('lon', (len(lons)))
-    lat = f.createDimension('lat', (len(lats)))
+    if lats.ndim == 1:
+        lon = f.createDimension('lon', (len(lons)))
+        lat = f.createDimension('lat', (len(lats)))
+        dims = ('lat', 'lon', )
+        lon = f.createVariable('lon', 'f8', ('lon', ))
+        lat = f.createVariable('lat', 'f8', ('lat', ))
+    else:
+        f.createDimension('y', lats.shape[0])
+        f.createDimension('x', lats.shape[1])
+        dims = ('y', 'x', )
+        lon = f.createVariable('lon', 'f8', dims)
+        lat = f.createVariable('lat', 'f8', dims)
 
     # initialize variables
     time = f.createVariable('time', 'f8', ('time'))
     time_step = f.createVariable('time_step', 'i8', ('time', ))
-    lon = f.createVariable('lon', 'f8', ('lon', ))
-    lat = f.createVariable('lat', 'f8', ('lat', ))
-    fraction = f.createVariable('fraction', 'f8', ('lat', 'lon', ),
+    fraction = f.createVariable('fraction', 'f8', dims,
                                 fill_value = NODATA)
-    UHS = f.createVariable('unit_hydrograph', 'f8', ('time', 'lat', 'lon', ),
+    UHS = f.createVariable('unit_hydrograph', 'f8', ('time', ) + dims,
                             fill_value = NODATA)
 
     # write attributes for netcdf
@@ -664,6 +1601,635 @@ def write_netcdf(basin_x, basin_y, lons, lats, times, time_steps, time_res, UH_S
 
     return string
 
+##############################################################################
+##  Consolidated output store
+##  Appends the flattened UH_S and fractions of each outlet to a single netCDF
+##  with a ragged (contiguous) points dimension and an outlet index table
+##############################################################################
+def append_store(store_file, basin_x, basin_y, basin_id, lons, lats, x_inds,
+                 y_inds, times, time_steps, time_res, UH_S, fractions, 
+                 velocity, diffusion, verbose):
+    """
+    Append one outlet to the consolidated store (store_file).  (UH_S) is the
+    flattened unit hydrograph [time, point] of the catchment cells, the other
+    point arrays are 1-D.  Point indices refer to the global input grid.
+    The store is created on first use (main removes the store of an earlier
+    run, see reset_output).  Outlet (i) owns points 
+    outlet_start[i]:outlet_start[i]+outlet_count[i].
+    """
+    if not os.path.exists(store_file):
+        create_store(store_file, times, time_steps, time_res)
+    f = Dataset(store_file, 'a')
+    if len(f.dimensions['time']) != UH_S.shape[0]:
+        f.close()
+        raise ValueError('UH length (%i) does not match %s (%i)' 
+                         % (UH_S.shape[0], store_file, 
+                            len(f.dimensions['time'])))
+    start = len(f.dimensions['points'])
+    end = start + len(fractions)
+    outlet = len(f.dimensions['outlets'])
+    if verbose:
+        print 'Appending outlet %i (%i points) to %s' \
+                % (outlet, len(fractions), store_file)
+
+    f.variables['unit_hydrograph'][:, start:end] = UH_S
+    f.variables['fraction'][start:end] = fractions
+    f.variables['lon'][start:end] = lons
+    f.variables['lat'][start:end] = lats
+    f.variables['x_ind'][start:end] = x_inds
+    f.variables['y_ind'][start:end] = y_inds
+
+    f.variables['outlet_lon'][outlet] = basin_x
+    f.variables['outlet_lat'][outlet] = basin_y
+    f.variables['outlet_start'][outlet] = start
+    f.variables['outlet_count'][outlet] = end - start
+    f.variables['basin_id'][outlet] = basin_id
+    f.variables['velocity'][outlet] = velocity
+    f.variables['diffusion'][outlet] = diffusion
+    f.history += '\n%s: appended outlet %i (%.8f, %.8f)' \
+                 % (tm.ctime(tm.time()), outlet, basin_x, basin_y)
+    f.close()
+
+    return store_file
+
+def reset_output(out_type, out_file, verbose):
+    """
+    Outlets are appended to the store or parameter file (out_type = store 
+    or rvic_params) during a run, remove the (out_file) of an earlier run so
+    its outlets are not duplicated (and their fractions adjusted again).  
+    Called once at the start of main.
+    """
+    if out_type in ['store', 'rvic_params'] and os.path.exists(out_file):
+        if verbose:
+            print 'Removing %s of an earlier run' % out_file
+        os.remove(out_file)
+    return
+
+def create_store(store_file, times, time_steps, time_res):
+    """
+    Create an empty consolidated store.  Both the points and outlets 
+    dimensions are unlimited so outlets can be appended one at a time.
+    """
+    f = Dataset(store_file, 'w', format = 'NETCDF4')
+
+    # set dimensions
+    f.createDimension('time', len(times))
+    f.createDimension('points', None)
+    f.createDimension('outlets', None)
+
+    # initialize variables
+    time = f.createVariable('time', 'f8', ('time', ))
+    time_step = f.createVariable('time_step', 'i8', ('time', ))
+    # chunk along points so a full read is a few large sequential reads
+    UHS = f.createVariable('unit_hydrograph', 'f8', ('time', 'points', ),
+                           chunksizes = (len(times), 4096))
+    fraction = f.createVariable('fraction', 'f8', ('points', ),
+                                chunksizes = (65536, ))
+    lon = f.createVariable('lon', 'f8', ('points', ), chunksizes = (65536, ))
+    lat = f.createVariable('lat', 'f8', ('points', ), chunksizes = (65536, ))
+    x_ind = f.createVariable('x_ind', 'i4', ('points', ), 
+                             chunksizes = (65536, ))
+    y_ind = f.createVariable('y_ind', 'i4', ('points', ), 
+                             chunksizes = (65536, ))
+    outlet_lon = f.createVariable('outlet_lon', 'f8', ('outlets', ))
+    outlet_lat = f.createVariable('outlet_lat', 'f8', ('outlets', ))
+    outlet_start = f.createVariable('outlet_start', 'i8', ('outlets', ))
+    outlet_count = f.createVariable('outlet_count', 'i8', ('outlets', ))
+    basin_id = f.createVariable('basin_id', 'i8', ('outlets', ))
+    velocity = f.createVariable('velocity', 'f8', ('outlets', ))
+    diffusion = f.createVariable('diffusion', 'f8', ('outlets', ))
+
+    # write attributes for netcdf
+    f.description = 'Consolidated UH_S store'
+    f.created = tm.ctime(tm.time())
+    f.history = ' '.join(sys.argv)
+    f.source = sys.argv[0] # returns the name of script used
+
+    time.units = 'seconds since 0001-1-1 0:0:0'
+    time.calendar = 'noleap'
+    time.longname = 'time'
+    time.type_prefered = 'int'
+    time.description = 'Seconds since initial impulse'
+
+    time_step.longname = 'timestep'
+    time_step.type_prefered = 'int'
+    time_step.description = 'timestep number'
+    time_step.resolution = time_res
+
+    UHS.units = 'unitless'
+    UHS.description = 'flattened unit hydrograph'
+    fraction.description = 'fraction of grid cell contributing to outlet location'
+    lon.long_name = 'longitude coordinate'
+    lon.units = 'degrees_east'
+    lat.long_name = 'latitude coordinate'
+    lat.units = 'degrees_north'
+    x_ind.description = 'x index location in input grid'
+    y_ind.description = 'y index location in input grid'
+
+    outlet_lon.units = 'degrees_east'
+    outlet_lat.units = 'degrees_north'
+    outlet_start.description = 'index of first point of outlet'
+    outlet_count.description = 'number of points of outlet'
+    outlet_count.sample_dimension = 'points'
+    basin_id.description = 'global basin id of outlet'
+
+    time_step[:] = time_steps
+    time[:] = times
+    f.close()
+    return
+
+def read_store(store_file, verbose = False):
+    """
+    Read the whole consolidated store with one read per variable.  Returns the
+    outlet table and the flattened point data as dictionaries. 
+    """
+    if verbose:
+        print 'Reading consolidated store: %s' % store_file
+    f = Dataset(store_file, 'r')
+    outlets = {}
+    for var in ['outlet_lon', 'outlet_lat', 'outlet_start', 'outlet_count', 
+                'basin_id', 'velocity', 'diffusion']:
+        outlets[var] = f.variables[var][:]
+    points = {}
+    for var in ['time', 'unit_hydrograph', 'fraction', 'lon', 'lat', 'x_ind',
+                'y_ind']:
+        points[var] = f.variables[var][:]
+    f.close()
+    return outlets, points
+
+##############################################################################
+##  RVIC parameter file
+##  Writes the flattened uh/fraction layout of adjust_fractions.write_param_file
+##  directly, one outlet at a time, when the routing grid is the target grid
+##############################################################################
+def open_param_writer(param_file, domain_file):
+    """
+    Setup the RVIC parameter file writer (a dict) of a run of outlets: the 
+    domain_file grids are read once here and (param_file) is opened once, on
+    the first append_param_file, and held open until close_param_writer.
+    """
+    f = Dataset(domain_file, 'r')
+    writer = {'param_file':param_file, 'domain_file':domain_file, 
+              'file':None}
+    writer['area'] = f.variables['area'][:] * earthRadius * earthRadius
+    writer['mask'] = f.variables['mask'][:]
+    writer['xc'] = f.variables['xc'][:]
+    writer['yc'] = f.variables['yc'][:]
+    f.close()
+    return writer
+
+def close_param_writer(writer):
+    """
+    Close the parameter file of the writer, if open.
+    """
+    if writer['file']:
+        writer['file'].close()
+        writer['file'] = None
+    return
+
+def append_param_file(writer, basin_x, basin_y, x_outlet, y_outlet, x_inds, 
+                      y_inds, UH_S, fractions, timestep, subset_length, 
+                      threshold, verbose):
+    """
+    Append one outlet to the RVIC parameter file of the (writer, see 
+    open_param_writer).  Indices are global indices in the routing grid, 
+    which must be the domain_file grid.  Points outside the land mask are 
+    dropped, the UHs are subset (if subset_length) and scaled by 
+    fraction*area/area_outlet as in adjust_fractions.  The file is created 
+    on first use (main removes the file of an earlier run, see 
+    reset_output).
+    """
+    param_file = writer['param_file']
+    area, mask = writer['area'], writer['mask']
+    if (x_inds.max() >= area.shape[1] or y_inds.max() >= area.shape[0]):
+        raise ValueError('Routing grid does not match %s' 
+                         % writer['domain_file'])
+
+    keep = np.nonzero((fractions > 0.0)*(mask[y_inds, x_inds] == 1))[0]
+    x_inds, y_inds = x_inds[keep], y_inds[keep]
+    fractions = fractions[keep]
+    full_length = UH_S.shape[0]
+    if subset_length:
+        offset, uh, full_length = subset(UH_S[:, keep], subset_length, 
+                                         threshold)
+    else:
+        subset_length = full_length
+        offset = np.zeros(len(keep), dtype = int)
+        uh = UH_S[:, keep]
+    uh = uh * fractions * area[y_inds, x_inds] / area[y_outlet, x_outlet]
+
+    if writer['file'] is None:
+        if not os.path.exists(param_file):
+            create_param_file(param_file, writer['domain_file'], subset_length,
+                              full_length, timestep)
+        writer['file'] = Dataset(param_file, 'a')
+    f = writer['file']
+    if len(f.dimensions['time']) != subset_length:
+        raise ValueError('UH length (%i) does not match %s' 
+                         % (subset_length, param_file))
+    start = len(f.dimensions['n_points'])
+    end = start + len(keep)
+    outlet = len(f.dimensions['n_outlets'])
+    if verbose:
+        print 'Appending outlet %i (%i points) to %s' \
+                % (outlet, len(keep), param_file)
+
+    f.variables['uh_point'][:, start:end] = uh
+    f.variables['frac_point'][start:end] = fractions
+    f.variables['cell_id_point'][start:end] = y_inds*area.shape[1] + x_inds
+    f.variables['x_ind_point'][start:end] = x_inds
+    f.variables['y_ind_point'][start:end] = y_inds
+    f.variables['lon_point'][start:end] = writer['xc'][y_inds, x_inds]
+    f.variables['lat_point'][start:end] = writer['yc'][y_inds, x_inds]
+    f.variables['t_offset_point'][start:end] = offset
+    f.variables['point2outlet_index'][start:end] = outlet
+
+    f.variables['cell_id_outlet'][outlet] = y_outlet*area.shape[1] + x_outlet
+    f.variables['outlet_num'][outlet] = outlet
+    f.variables['x_ind_outlet'][outlet] = x_outlet
+    f.variables['y_ind_outlet'][outlet] = y_outlet
+    f.variables['lon_outlet'][outlet] = basin_x
+    f.variables['lat_outlet'][outlet] = basin_y
+
+    return param_file
+
+def create_param_file(param_file, domain_file, subset_length, full_length, 
+                      timestep):
+    """
+    Create an empty RVIC parameter file.  The variables match 
+    adjust_fractions.write_param_file, n_points and n_outlets are unlimited 
+    so outlets can be appended one at a time.
+    """
+    f = Dataset(param_file, 'w', format = 'NETCDF4')
+
+    # set dimensions
+    f.createDimension('time', subset_length)
+    f.createDimension('n_points', None)
+    f.createDimension('n_outlets', None)
+
+    # Variables
+    time = f.createVariable('time','i4',('time',))
+    time.standard_name = 'time'    
+    time.units = 'timesteps'
+    time.subset_length = subset_length
+    time.full_time_length = full_length
+    time.timestep = timestep
+    time[:] = np.arange(subset_length)
+
+    uh_point = f.createVariable('uh_point', 'f8', ('time', 'n_points',),
+                                chunksizes = (subset_length, 4096))
+    uh_point.long_name = 'Unit Hydrographs'
+    uh_point.units = 'unitless'
+    uh_point.description = 'Subset and flattened unit hydrograph'
+
+    frac_point = f.createVariable('frac_point', 'f8', ('n_points',))
+    frac_point.long_name = 'Fraction'
+    frac_point.units = 'unitless'
+    frac_point.description = 'Fraction of grid cell contributing to outlet'
+
+    cell_id_point = f.createVariable('cell_id_point', 'i4', ('n_points',))
+    cell_id_point.long_name = 'Cell ID Point'
+    cell_id_point.units = 'unitless'
+    cell_id_point.description = 'Land Model Grid Cell ID'
+
+    y_ind_point = f.createVariable('y_ind_point', 'i4',('n_points',))
+    y_ind_point.long_name = 'Y Index Location'
+    y_ind_point.units = 'unitless'
+    y_ind_point.description = 'Y Index Location of Origin Grid Cell'
+
+    x_ind_point = f.createVariable('x_ind_point', 'i4', ('n_points',))
+    x_ind_point.long_name = 'X Index Location'
+    x_ind_point.units = 'unitless'
+    x_ind_point.description = 'X Index Location of Origin Grid Cell'
+
+    lon_point = f.createVariable('lon_point', 'f8', ('n_points',))
+    lon_point.long_name = 'longitude coordinate'
+    lon_point.units = 'degrees_east'
+    lon_point.description = 'Longitude Coordinate of Origin Grid Cell'
+
+    lat_point = f.createVariable('lat_point', 'f8', ('n_points',))
+    lat_point.long_name = 'latitude coordinate'
+    lat_point.units = 'degrees_north'
+    lat_point.description = 'Latitude Coordinate of Origin Grid Cell'
+
+    time_offset_point = f.createVariable('t_offset_point', 'i4', ('n_points',))
+    time_offset_point.long_name = 'time_offset'
+    time_offset_point.units = 'timesteps'
+    time_offset_point.description = 'Number of ommited leading timesteps'
+
+    point2outlet_index = f.createVariable('point2outlet_index', 'i4', 
+                                          ('n_points',))
+    point2outlet_index.long_name = 'Point to outlet index mapping'
+    point2outlet_index.description = '1D outlet index associated with source point'
+
+    cell_id_outlet = f.createVariable('cell_id_outlet', 'i4', ('n_outlets',))
+    cell_id_outlet.long_name = 'Outlet ID Point'
+    cell_id_outlet.units = 'unitless'
+    cell_id_outlet.description = 'Outlet Grid Cell ID'
+
+    outlet_num = f.createVariable('outlet_num', 'i4', ('n_outlets',))
+    outlet_num.long_name = 'Outlet Index'
+    outlet_num.description = 'Outlet Point Index'
+
+    x_ind_outlet = f.createVariable('x_ind_outlet', 'i4', ('n_outlets',))
+    x_ind_outlet.long_name = 'X Index Location'
+    x_ind_outlet.units = 'unitless'
+    x_ind_outlet.description = 'X Index Location of Outlet Grid Cell'
+       
+    y_ind_outlet = f.createVariable('y_ind_outlet', 'i4', ('n_outlets',))
+    y_ind_outlet.long_name = 'Y Index Location'
+    y_ind_outlet.units = 'unitless'
+    y_ind_outlet.description = 'Y Index Location of Outlet Grid Cell'
+
+    lon_outlet = f.createVariable('lon_outlet', 'f8', ('n_outlets',))
+    lon_outlet.long_name = 'longitude coordinate'
+    lon_outlet.units = 'degrees_east'
+    lon_outlet.description = 'Longitude Coordinate of Outlet Grid Cell'
+
+    lat_outlet = f.createVariable('lat_outlet', 'f8', ('n_outlets',))
+    lat_outlet.long_name = 'latitude coordinate'
+    lat_outlet.units = 'degrees_north'
+    lat_outlet.description = 'Latitude Coordinate of Outlet Grid Cell'
+
+    full_length_var = f.createVariable('full_length','i4')
+    full_length_var.description = 'Number of timesteps in the original flull length unit hydrograph (before subseting)'
+    full_length_var.units = 'timesteps'
+    full_length_var[:] = full_length
+
+    subset_length_var = f.createVariable('subset_length','i4')
+    subset_length_var.description = 'Number of timesteps included in subset, all others assumed to be zero'
+    subset_length_var.units = 'timesteps'
+    subset_length_var[:] = subset_length
+
+    timestep_var = f.createVariable('timestep','i4')
+    timestep_var.description = 'Unit Hydrograph Timestep'
+    timestep_var.units = 'seconds'
+    timestep_var[:] = timestep
+
+    # Globals
+    f.description = 'Flattened uh/fraction RVIC parameter file'
+    f.history = 'Created ' + tm.ctime(tm.time())
+    f.source = sys.argv[0] # returns the name of script used
+    f.domain_file = os.path.split(domain_file)[1]
+    f.close()
+    return
+
+def adjust_param_fractions(param_file, domain_file, verbose, chunk = 4096):
+    """
+    Once all outlets have been written, scale back points whose aggregated
+    fraction (over all outlets) exceeds the domain grid fraction, as 
+    adjust_fractions does.  Only the affected uh_point columns are rewritten,
+    (chunk) columns at a time.
+    """
+    f = Dataset(domain_file, 'r')
+    grid_fracs = f.variables['frac'][:].ravel()
+    f.close()
+
+    f = Dataset(param_file, 'a')
+    frac_points = f.variables['frac_point'][:]
+    cell_ids = f.variables['cell_id_point'][:]
+    agg_fracs = np.bincount(cell_ids, weights = frac_points, 
+                            minlength = len(grid_fracs))
+    ratio = np.ones(len(grid_fracs))
+    over = np.nonzero(agg_fracs > grid_fracs)[0]
+    ratio[over] = grid_fracs[over]/agg_fracs[over]
+    points = np.nonzero(ratio[cell_ids] < 1.)[0]
+    if verbose:
+        print 'Adjusting fractions of %i points in %s' % (len(points), 
+                                                         param_file)
+    if len(points):
+        r = ratio[cell_ids]
+        f.variables['frac_point'][points] = frac_points[points]*r[points]
+        for start in xrange(points.min(), points.max()+1, chunk):
+            cols = points[(points >= start)*(points < start+chunk)]
+            if len(cols):
+                uh = f.variables['uh_point'][:, cols.min():cols.max()+1]
+                uh[:, cols-cols.min()] *= r[cols]
+                f.variables['uh_point'][:, cols.min():cols.max()+1] = uh
+    f.close()
+    return
+
+def subset(uh, subset, threshold):
+    """
+    Clip each UH [time, point] to (subset) timesteps starting at its first 
+    value > (threshold) and renormalize.  Also used by 
+    tools/adjust_fractions.py.
+    """
+    full_length = uh.shape[0]
+    offset = np.empty(uh.shape[1], dtype = int)
+    out_uh = np.zeros((subset, uh.shape[1]))
+    for i in xrange(uh.shape[1]):
+        offset[i]  = np.nonzero(uh[:, i] > threshold)[0][0]     # find position of first index > threshold
+        end = np.minimum(uh.shape[0],offset[i]+subset)        # find end point
+        out_uh[:end-offset[i], i] = uh[offset[i]:end, i]/uh[offset[i]:end, i].sum() # clip and normalize
+    return offset, out_uh, full_length
+
+##############################################################################
+##  Routing Service
+##  Keeps the domain (and flow network) resident and routes requests sent as
+##  JSON over localhost HTTP or a Unix socket on a pool of worker processes.
+##  POST {"lat":, "lon":, "velocity":, "diffusion":, "out_path":} routes one
+##  outlet (UH grid written to out_path), GET /status returns the statistics.
+##############################################################################
+service = {}
+
+def serve(address, workers, infile, UHfile, velocity, diffusion, verbose, 
+          NODATA, CELL_FLOWTIME, BASIN_FLOWTIME, PREC, OUTPUT_INTERVAL, 
+          DAY_SECONDS, network, domain = None):
+    """
+    Load the domain once (unless given) and serve routing requests on 
+    (address) until interrupted.  (address) is host:port (localhost only) or
+    a socket path.
+    """
+    if domain is None:
+        domain = read_domain(infile, velocity, diffusion, verbose)
+    service['domain'] = domain
+    service['network'] = network
+    service['args'] = {'infile':infile, 'UHfile':UHfile, 'velocity':velocity,
+                       'diffusion':diffusion, 'NODATA':NODATA, 
+                       'CELL_FLOWTIME':CELL_FLOWTIME, 
+                       'BASIN_FLOWTIME':BASIN_FLOWTIME, 'PREC':PREC,
+                       'OUTPUT_INTERVAL':OUTPUT_INTERVAL, 
+                       'DAY_SECONDS':DAY_SECONDS}
+    service['verbose'] = verbose
+    service['lock'] = threading.Lock()
+    service['stats'] = {'queue_depth':0, 'completed':0, 'failed':0, 
+                        'total_latency':0., 'max_latency':0.}
+
+    # workers are forked after the domain is loaded so they share it, only
+    # the parent handles SIGINT/SIGTERM so the pool can be shut down cleanly
+    service['pool'] = multiprocessing.Pool(workers, signal.signal, 
+                                           (signal.SIGINT, signal.SIG_IGN))
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = make_server(address)
+    print 'Routing service listening on %s with %i workers' % (address, workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service['pool'].close()
+        service['pool'].join()
+        if not ':' in address and os.path.exists(address):
+            os.remove(address)
+    print 'Routing service stopped, %s' % json.dumps(service['stats'])
+    return
+
+def make_server(address):
+    """
+    Make a threaded HTTP server on localhost:port or a Unix socket path.
+    """
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        if host not in ['localhost', '127.0.0.1', '']:
+            raise ValueError('Routing service only binds to localhost')
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        return Server(('127.0.0.1', int(port)), RoutHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+        return Server(address, RoutHandler)
+
+class RoutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Hands each routing request to the worker pool and waits for the result.
+    """
+    def do_POST(self):
+        start = tm.time()
+        stats = service['stats']
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = check_request(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            with service['lock']:
+                stats['failed'] += 1
+            self.respond(400, {'error':'%s: %s' % (type(e).__name__, e)})
+            return
+        try:
+            with service['lock']:
+                stats['queue_depth'] += 1
+                queue_depth = stats['queue_depth']
+            try:
+                out_file, run_time = service['pool'].apply_async(
+                    service_rout, (request, )).get()
+            finally:
+                with service['lock']:
+                    stats['queue_depth'] -= 1
+        except Exception as e:
+            with service['lock']:
+                stats['failed'] += 1
+            self.respond(500, {'error':'%s: %s' % (type(e).__name__, e)})
+            return
+        latency = tm.time() - start
+        with service['lock']:
+            stats['completed'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+        if service['verbose']:
+            print 'Routed to (%s, %s) in %.3f s (%.3f s routing, queue depth %i)' \
+                    % (request['lat'], request['lon'], latency, run_time, 
+                       queue_depth)
+        self.respond(200, {'out_file':out_file, 'latency':latency, 
+                           'run_time':run_time, 'queue_depth':queue_depth})
+
+    def do_GET(self):
+        with service['lock']:
+            stats = dict(service['stats'])
+        if stats['completed']:
+            stats['mean_latency'] = stats['total_latency']/stats['completed']
+        self.respond(200, stats)
+
+    def respond(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address is empty on Unix sockets
+        if service['verbose']:
+            sys.stderr.write('[%s] %s\n' % (self.log_date_time_string(), 
+                                            format % args))
+
+def check_request(request):
+    """
+    Check a service request and fill in the service defaults, returns the 
+    request.  Raises ValueError if it can't be routed: lat/lon missing or 
+    not numbers, or no velocity/diffusion (null or 0 in the request or the 
+    service default) when the domain has no velocity/diffusion grid.
+    """
+    if not isinstance(request, dict):
+        raise ValueError('request must be a JSON object')
+    args = service['args']
+    checked = {'out_path':request.get('out_path') or ''}
+    if not isinstance(checked['out_path'], basestring):
+        raise ValueError('out_path must be a string')
+    for var in ['lat', 'lon', 'velocity', 'diffusion']:
+        value = request.get(var, args.get(var))
+        if value is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError('%s must be a number, not %r' % (var, value))
+        if var in ['lat', 'lon'] and value is None:
+            raise ValueError('request has no %s' % var)
+        if not value and var in ['velocity', 'diffusion'] and \
+                var not in service['domain']:
+            raise ValueError('no %s given and the domain has no %s grid' 
+                             % (var, var))
+        checked[var] = value
+    return checked
+
+def service_rout(request):
+    """
+    Route one service request (see check_request) in a worker process, 
+    returns the output file and the time spent routing.
+    """
+    start = tm.time()
+    args = service['args']
+    request = check_request(request)
+    out_file = rout(args['infile'], args['UHfile'], request['lat'], 
+                    request['lon'], request['velocity'], 
+                    request['diffusion'], False,
+                    args['NODATA'], args['CELL_FLOWTIME'], 
+                    args['BASIN_FLOWTIME'], args['PREC'], 
+                    args['OUTPUT_INTERVAL'], args['DAY_SECONDS'], 
+                    out_file = request['out_path'],
+                    network = service['network'], domain = service['domain'])
+    return out_file, tm.time() - start
+
+def service_request(address, request = None):
+    """
+    Client for the routing service.  Sends (request) (dictionary) or asks for
+    the service statistics if no request is given.  Returns the decoded reply.
+    """
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        sock = socket.create_connection((host or 'localhost', int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    if request is None:
+        sock.sendall('GET /status HTTP/1.0\r\n\r\n')
+    else:
+        body = json.dumps(request)
+        sock.sendall('POST /rout HTTP/1.0\r\nContent-Type: application/json'
+                     '\r\nContent-Length: %i\r\n\r\n%s' % (len(body), body))
+    reply = ''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        reply += data
+    sock.close()
+    return json.loads(reply.split('\r\n\r\n', 1)[1])
+
 ##############################################################################
 # Run Program
 ##############################################################################
@@ -0,0 +1,115 @@
+#!/usr/local/bin/python
+"""
+Timing benchmarks for the convolution kernels.
+
+These are not tests, they print timings for the alternatives on grids of
+realistic size so changes to the hot paths can be checked.
+"""
+import argparse
+import coup_conv
+import numpy as np
+import time as tm
+from ConvolutionUnitTests import random_point_dict
+
+def main():
+    ny, nx, outlets, steps, repeats = process_command_line()
+    Benchmark_Grid_Scatter(ny, nx, outlets, steps, repeats)
+    Benchmark_Coupler_Step(ny, nx, outlets, steps)
+    return
+
+def Benchmark_Grid_Scatter(ny, nx, outlets, steps, repeats):
+    """
+    Time putting outlet streamflows on the output grid
+    1.  Per point loop over the outlets
+    2.  Fancy indexing with the y and x arrays
+    3.  One scatter with the precomputed flat indices (coup_conv)
+    """
+    shape = (ny, nx)
+    cells = np.random.permutation(ny*nx)[:outlets]
+    conv_dict = {'y': cells // nx, 'x': cells % nx}
+    flows = np.random.random((steps, outlets))
+
+    def per_point():
+        out_flow = np.zeros((steps, ny, nx))
+        for step in xrange(steps):
+            for p in xrange(outlets):
+                out_flow[step, conv_dict['y'][p], conv_dict['x'][p]] = flows[step, p]
+        return out_flow
+
+    def fancy():
+        out_flow = np.zeros((steps, ny, nx))
+        for step in xrange(steps):
+            out_flow[step, conv_dict['y'], conv_dict['x']] = flows[step]
+        return out_flow
+
+    def flat():
+        out_flow = np.zeros((steps, ny, nx))
+        out_flow.reshape(steps, -1)[:, coup_conv.flat_index(conv_dict, shape)] = flows
+        return out_flow
+
+    print 'Grid %i x %i, %i outlets, %i steps' %(ny, nx, outlets, steps)
+    expected = per_point()
+    for name, func in [('per point', per_point), ('fancy index', fancy),
+                       ('flat scatter', flat)]:
+        assert np.array_equal(func(), expected)
+        t0 = tm.time()
+        for r in xrange(repeats):
+            func()
+        print '%-14s %10.3f ms/step' %(name, (tm.time()-t0)*1000/repeats/steps)
+    return
+
+def Benchmark_Coupler_Step(ny, nx, outlets, steps, uh_length=100, 
+                           max_sources=40):
+    """
+    Time each call of the in memory coupling interface (ConvolutionModel)
+    for unit hydrographs of uh_length lags and up to max_sources source 
+    cells per outlet, with grid and array streamflow
+    """
+    cells = np.random.permutation(ny*nx)[:outlets]
+    point_dict = random_point_dict(np.random.randint(1, max_sources, outlets),
+                                   zip(cells // nx, cells % nx), uh_length,
+                                   grid_shape=(ny, nx))
+    conv_dict = coup_conv.make_conv_dict(point_dict, (ny, nx))
+    fluxes = np.random.random((steps, ny, nx))
+
+    for shape in [(ny, nx), (outlets, )]:
+        model = coup_conv.ConvolutionModel()
+        model.initialize_from(conv_dict, (ny, nx), shape)
+        times = {'step':0., 'get_streamflow':0., 'get_state':0., 
+                 'set_state':0.}
+        for step in xrange(steps):
+            t0 = tm.time()
+            model.step(fluxes[step], step)
+            t1 = tm.time()
+            model.get_streamflow()
+            t2 = tm.time()
+            state = model.get_state()
+            t3 = tm.time()
+            model.set_state(state)
+            t4 = tm.time()
+            times['step'] += t1 - t0
+            times['get_streamflow'] += t2 - t1
+            times['get_state'] += t3 - t2
+            times['set_state'] += t4 - t3
+        model.finalize()
+        print 'Coupler calls, %i outlets, %i nonzeros, streamflow %s' \
+            % (outlets, conv_dict['operator'].nnz, shape)
+        for name in ['step', 'get_streamflow', 'get_state', 'set_state']:
+            print '%-14s %10.3f ms/call' %(name, times[name]*1000/steps)
+    return
+
+def process_command_line():
+    """
+    Get the benchmark sizes from the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ny", type=int, default=205, help="Grid rows")
+    parser.add_argument("--nx", type=int, default=275, help="Grid columns")
+    parser.add_argument("--outlets", type=int, default=5000, help="Number of outlets")
+    parser.add_argument("--steps", type=int, default=24, help="Timesteps per call")
+    parser.add_argument("--repeats", type=int, default=10, help="Calls to time")
+    args = parser.parse_args()
+    return args.ny, args.nx, args.outlets, args.steps, args.repeats
+
+if __name__ == "__main__":
+    main()
@@ -31,10 +31,10 @@ def Test_Binary_Resart(config_file, N = 24):
     out_path1 = os.path.join(out_path,'continuous')
     if not os.path.exists(out_path1):
         os.makedirs(out_path1)
-    point_dict,out_dict,area,shape,counts = coup_conv.init(uh_files,flux_files,grid_file,
-                                                           initial_state,outputs,options)
+    point_dict,conv_dict,out_dict,area,shape,counts = coup_conv.init(uh_files,flux_files,grid_file,
+                                                                     initial_state,outputs,options)
     out_name,state_name,restart_name,counts = coup_conv.run(Config,flux_files,out_path1,outputs,
-                                                            options,point_dict,out_dict,area,shape,counts)
+                                                            options,point_dict,conv_dict,out_dict,area,shape,counts)
     coup_conv.final(counts,outputs,out_path)
 
     print "Done with run 1, starting run 2 now..."
@@ -54,10 +54,10 @@ def Test_Binary_Resart(config_file, N = 24):
                 new_list.append(flux_files.popleft())
             except: pass
         Config,uh_files,junk,grid_file,out_path,initial_state,outputs,options = coup_conv.process_config_file(config_file)
-        point_dict,out_dict,area,shape,counts = coup_conv.init(uh_files,new_list,grid_file,
-                                                               initial_state,outputs,options)
+        point_dict,conv_dict,out_dict,area,shape,counts = coup_conv.init(uh_files,new_list,grid_file,
+                                                                         initial_state,outputs,options)
         out_name,state_name,restart_name,counts = coup_conv.run(Config,new_list,out_path2,outputs,
-                                                                options,point_dict,out_dict,area,shape,counts)
+                                                                options,point_dict,conv_dict,out_dict,area,shape,counts)
         config_file = restart_name
     coup_conv.final(counts,outputs,out_path2)
 
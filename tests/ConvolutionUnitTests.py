@@ -2,10 +2,59 @@
 
 import numpy as np
 from coup_conv import *
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import Queue
 import unittest
 
+def write_uh_files(temp_dir, outlets):
+    # Write a small unit hydrograph file (2 source cells) for each outlet
+    uh_files = []
+    for i, (y, x) in enumerate(outlets):
+        uh_files.append(os.path.join(temp_dir, 'uh_%i.nc' % i))
+        f = Dataset(uh_files[-1], 'w')
+        f.createDimension('time', 4)
+        f.createDimension('npoints', 2)
+        time = f.createVariable('time', 'f8', ('time', ))
+        time.units = 'days since 0-01-01 00:00:00'
+        time[:] = np.arange(4)
+        f.createVariable('xi', 'i4', ('npoints', ))[:] = [x, 1]
+        f.createVariable('yi', 'i4', ('npoints', ))[:] = [y, 1]
+        f.createVariable('fraction', 'f8', ('npoints', ))[:] = [1., 0.5]
+        f.createVariable('unit_hydrograph', 'f8', 
+                         ('time', 'npoints'))[:] = np.random.random((4, 2))
+        f.outlet_x, f.outlet_y, f.outlet_lat, f.outlet_lon = x, y, 0., 0.
+        f.close()
+    return uh_files
+
+def random_point_dict(sizes, outlets, tlen, offsets=False, grid_shape=(5, 5)):
+    # Random unit hydrographs (tlen lags) of sizes[i] source cells for each
+    # (y, x) outlet, with random time offsets of up to 2 lags if offsets
+    point_dict = OrderedDict()
+    for n, (y, x) in zip(sizes, outlets):
+        if offsets:
+            time_offset = np.random.randint(0, 3, n)
+        else:
+            time_offset = np.zeros(n, dtype=int)
+        point_dict[(y, x)] = {'yi':np.random.randint(0, grid_shape[0], n),
+                              'xi':np.random.randint(0, grid_shape[1], n),
+                              'uh':np.random.random((tlen, n)), 
+                              'time':np.arange(tlen),
+                              'time_offset':time_offset,
+                              'full_length':tlen + 2*offsets}
+    return point_dict
+
+
 class TestConvolutionFuctions(unittest.TestCase):
 
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
     def test_ring_shift(self):
         # Make sure the j+1 element ends up in the j location
         ring1 = np.random.random(10)
@@ -42,6 +91,334 @@ class TestConvolutionFuctions(unittest.TestCase):
         flux = np.random.random(size=(10,10))
         self.flow = (flux[ys,xs]*UH).sum(axis=1)
         self.assertEqual(self.flow.ndim,1)
-        
-suite = unittest.TestLoader().loadTestsFromTestCase(TestConvolutionFuctions)
-unittest.TextTestRunner(verbosity=2).run(suite)
+
+    def test_ring_head(self):
+        # Make sure moving the ring head gives the same streamflow and state
+        # as shifting a ring for each point
+        # (the last point has no source cells)
+        tlen = 7
+        point_dict = random_point_dict([3, 12, 1, 0], 
+                                       [(0, 1), (2, 3), (4, 0), (1, 1)], tlen)
+        uhs = [d['uh'] for d in point_dict.itervalues()]
+        conv_dict = make_conv_dict(point_dict, (5, 5))
+        rings = np.zeros((4, tlen))
+        for t in xrange(10):
+            flux = np.random.random((1, 5, 5))
+            conv_dict, out_flow, out_state, time_dict = convolve(point_dict, 
+                conv_dict, {'time_step':t}, flux, True, (4, ))
+            for i, d in enumerate(point_dict.itervalues()):
+                rings[i] += (flux[:, d['yi'], d['xi']]*uhs[i]).sum(axis=1)
+                np.testing.assert_allclose(out_flow[i], rings[i][0], rtol=1e-14)
+                rings[i][0] = 0
+                rings[i] = shift(rings[i], 1)
+            np.testing.assert_allclose(out_state, rings.T, rtol=1e-14)
+            self.assertEqual(out_flow[3], 0)
+
+    def test_convolve_block(self):
+        # Make sure a block of timesteps gives exactly the streamflow and 
+        # ring of convolving one timestep at a time
+        point_dict = random_point_dict([4, 9, 2], [(0, 1), (2, 3), (4, 0)], 6,
+                                       offsets=True)
+        conv_dicts = [make_conv_dict(point_dict, (5, 5))]
+        conv_dicts.append(dict(conv_dicts[0], ring=conv_dicts[0]['ring'].copy()))
+        fluxes = np.random.random((11, 25))
+        steps = []
+        for t in xrange(11):
+            steps.append(convolve(point_dict, conv_dicts[0], {'time_step':t}, 
+                                  fluxes[t], False, (5, 5))[1])
+        blocks = np.concatenate([convolve_block(conv_dicts[1], fluxes[i:i+4], 
+                                                (5, 5)) for i in [0, 4, 8]])
+        np.testing.assert_array_equal(blocks, steps)
+        np.testing.assert_array_equal(unwrap_ring(conv_dicts[0]), 
+                                      unwrap_ring(conv_dicts[1]))
+
+    def test_conv_workers(self):
+        # Make sure the convolution workers give exactly the streamflow and
+        # rings of one process, with points split by source cells
+        point_dict = random_point_dict([4, 9, 2, 5], 
+                                       [(0, 1), (2, 3), (4, 0), (1, 1)], 6, 
+                                       offsets=True)
+        conv_dicts = [make_conv_dict(point_dict, (5, 5))]
+        conv_dicts.append(dict(conv_dicts[0], ring=conv_dicts[0]['ring'].copy()))
+        groups, sources = partition_points(conv_dicts[0], 2)
+        np.testing.assert_array_equal(np.sort(np.concatenate(groups)), 
+                                      np.arange(4))
+        fluxes = np.random.random((11, 25))
+        blocks = convolve_block(conv_dicts[0], fluxes, (5, 5))
+        conv_pool = start_conv_workers(conv_dicts[1], 2, 4)
+        try:
+            parallel = convolve_parallel(conv_pool, conv_dicts[1], fluxes, 
+                                         (5, 5))
+            gather_rings(conv_pool, conv_dicts[1])
+        finally:
+            stop_conv_workers(conv_pool)
+        np.testing.assert_array_equal(parallel, blocks)
+        np.testing.assert_array_equal(unwrap_ring(conv_dicts[0]), 
+                                      unwrap_ring(conv_dicts[1]))
+
+    def test_convolution_model(self):
+        # Make sure the coupling interface gives the streamflow of 
+        # convolve_block, and a restored state the same streamflow again, 
+        # in this process and on convolution workers (restarted by set_state)
+        point_dict = random_point_dict([4, 9, 2], [(0, 1), (2, 3), (4, 0)], 6,
+                                       offsets=True)
+        conv_dict = make_conv_dict(point_dict, (5, 5))
+        fluxes = np.random.random((11, 5, 5))
+        blocks = convolve_block(dict(conv_dict, ring=conv_dict['ring'].copy()),
+                                fluxes.reshape(11, -1), (5, 5))
+        for conv_workers in [1, 2]:
+            model = ConvolutionModel()
+            model.initialize_from(dict(conv_dict, 
+                                       ring=conv_dict['ring'].copy()), 
+                                  (5, 5), (5, 5), conv_workers)
+            streamflow = []
+            for t in xrange(11):
+                model.step(fluxes[t], t)
+                streamflow.append(model.get_streamflow())
+                if t == 4:
+                    state = model.get_state()
+            np.testing.assert_allclose(streamflow, blocks)
+            model.set_state(state)
+            self.assertEqual(model.get_state()['time'], 4)
+            model.step_block(fluxes[5:], 10)
+            np.testing.assert_allclose(model.get_streamflow(), blocks[5:])
+            self.assertRaises(ValueError, model.step, fluxes[:2], 11)
+            model.finalize()
+
+    def test_time_offset(self):
+        # Make sure a subset unit hydrograph lands time_offset lags into a 
+        # ring of the full length
+        point_dict = OrderedDict()
+        point_dict[(0, 0)] = {'yi':np.array([0, 1]), 'xi':np.array([0, 1]),
+                              'uh':np.array([[1., 3.], [2., 0.]]), 
+                              'time':np.arange(2), 
+                              'time_offset':np.array([2, 0]), 'full_length':5}
+        conv_dict = make_conv_dict(point_dict, (2, 2))
+        self.assertEqual(conv_dict['operator'].nnz, 3)
+        np.testing.assert_array_equal(conv_dict['time'], np.arange(5))
+        flux = np.ones((1, 2, 2))
+        conv_dict, out_flow, out_state, time_dict = convolve(point_dict, 
+            conv_dict, {'time_step':0}, flux, True, (1, ))
+        self.assertEqual(out_flow[0], 3.)
+        np.testing.assert_array_equal(out_state[:, 0], [0., 1., 2., 0., 0.])
+
+    def test_read_param_file(self):
+        # Make sure the points of each outlet are gathered from a parameter 
+        # file (points of the outlets interleaved)
+        param_file = os.path.join(self.tmp_dir, 'params.nc')
+        f = Dataset(param_file, 'w')
+        f.createDimension('time', 3)
+        f.createDimension('n_points', 4)
+        f.createDimension('n_outlets', 2)
+        f.createVariable('time', 'i4', ('time', ))[:] = np.arange(3)
+        f.createVariable('timestep', 'i4')[:] = 43200
+        f.createVariable('full_length', 'i4')[:] = 5
+        uh = np.random.random((3, 4))
+        f.createVariable('uh_point', 'f8', ('time', 'n_points'))[:] = uh
+        for name, values in [('x_ind_point', [0, 1, 2, 3]), 
+                             ('y_ind_point', [1, 1, 0, 0]),
+                             ('t_offset_point', [0, 2, 1, 0]),
+                             ('point2outlet_index', [1, 0, 1, 0])]:
+            f.createVariable(name, 'i4', ('n_points', ))[:] = values
+        for name, values in [('x_ind_outlet', [3, 2]), ('y_ind_outlet', [0, 0]),
+                             ('lon_outlet', [3., 2.]), ('lat_outlet', [0., 0.])]:
+            f.createVariable(name, 'f8', ('n_outlets', ))[:] = values
+        f.close()
+        area = np.arange(1., 9.).reshape(2, 4)
+        point_dict = read_param_file(param_file, area, {'units':'m3/s'})
+        self.assertEqual(point_dict.keys(), [(0, 3), (0, 2)])
+        d = point_dict[(0, 2)]
+        np.testing.assert_array_equal(d['xi'], [0, 2])
+        np.testing.assert_array_equal(d['time_offset'], [0, 1])
+        np.testing.assert_array_equal(d['time'], [0., 0.5, 1.])
+        np.testing.assert_allclose(d['uh'], uh[:, [0, 2]]*area[0, 2])
+        self.assertEqual(d['full_length'], 5)
+
+    def test_pool_order(self):
+        # Make sure unit hydrograph files read by a pool keep their order
+        uh_files = write_uh_files(self.tmp_dir, [(1, 2), (0, 0), (1, 0)])
+        area = np.ones((2, 3))
+        point_dict, conv_dict, out_dict, counts = make_point_dict(
+            uh_files, area, {'units':'m3/s'}, {}, workers=2)
+        self.assertEqual(point_dict.keys(), [(1, 2), (0, 0), (1, 0)])
+        self.assertEqual(counts['points'], 3)
+
+    def test_snapshot(self):
+        # Make sure the prepared snapshot gives the same points and operator
+        # as reading the unit hydrograph files
+        uh_files = write_uh_files(self.tmp_dir, [(1, 2), (0, 0)])
+        snapshot_dir = os.path.join(self.tmp_dir, 'snapshots')
+        area = np.ones((2, 3))
+        dicts = []
+        for i in xrange(2):
+            dicts.append(make_point_dict(uh_files, area, {'units':'m3/s'}, {},
+                                         snapshot_dir=snapshot_dir))
+        self.assertEqual(len(os.listdir(snapshot_dir)), 1)
+        self.assertEqual(dicts[1][0].keys(), [(1, 2), (0, 0)])
+        self.assertEqual(dicts[1][3]['points'], 2)
+        np.testing.assert_array_equal(dicts[0][1]['operator'].toarray(), 
+                                      dicts[1][1]['operator'].toarray())
+        np.testing.assert_array_equal(dicts[0][1]['time'], dicts[1][1]['time'])
+
+    def test_write_buffered(self):
+        # Make sure buffered streamflows end up in one file per day, in order
+        outputs = {'out_type':'array', 'out_period':'day', 'flush_steps':2}
+        out_dict = {'units':'m3/s', 'outlet_xs':[0, 1], 'outlet_ys':[0, 0],
+                    'lats':[0., 0.], 'lons':[0., 1.]}
+        time_dict = {'units':'days since 0001-01-01', 'cal':'noleap', 
+                     'long_name':'time'}
+        writer = open_writer(self.tmp_dir, outputs, out_dict, (2, ))
+        flows = np.random.random((5, 2))
+        for i, t in enumerate([0.25, 0.5, 0.75, 1., 1.25]):
+            time_dict['time_step'] = np.array([t])
+            write_buffered(writer, 'case.vic.ha.0001-01-01-00000.nc', 
+                           flows[i:i+1], time_dict, {'verbose':False})
+        close_writer(writer)
+        self.assertEqual(writer['files'], 2)
+        f = Dataset(os.path.join(self.tmp_dir, 'case.vic.ha.0001-01-01.nc'))
+        np.testing.assert_array_equal(f.variables['Streamflow'][:], flows[:3])
+        np.testing.assert_array_equal(f.variables['time'][:], [0.25, 0.5, 0.75])
+        f.close()
+        f = Dataset(os.path.join(self.tmp_dir, 'case.vic.ha.0001-01-02.nc'))
+        np.testing.assert_array_equal(f.variables['Streamflow'][:], flows[3:])
+        f.close()
+
+        # A restart from 0.5 reopens the first file and only adds the times
+        # after its last one
+        writer = open_writer(self.tmp_dir, outputs, out_dict, (2, ))
+        more = np.random.random((4, 2))
+        for i, t in enumerate([0.5, 0.75, 1., 1.25]):
+            time_dict['time_step'] = np.array([t])
+            write_buffered(writer, 'case.vic.ha.0001-01-01-00000.nc', 
+                           more[i:i+1], time_dict, {'verbose':False})
+        time_dict['time_step'] = np.array([1.5])
+        write_buffered(writer, 'case.vic.ha.0001-01-01-00000.nc', 
+                       more[3:], time_dict, {'verbose':False})
+        close_writer(writer)
+        self.assertEqual(writer['files'], 0)
+        f = Dataset(os.path.join(self.tmp_dir, 'case.vic.ha.0001-01-01.nc'))
+        np.testing.assert_array_equal(f.variables['time'][:], [0.25, 0.5, 0.75])
+        np.testing.assert_array_equal(f.variables['Streamflow'][:], flows[:3])
+        f.close()
+        f = Dataset(os.path.join(self.tmp_dir, 'case.vic.ha.0001-01-02.nc'))
+        np.testing.assert_array_equal(f.variables['time'][:], [1., 1.25, 1.5])
+        np.testing.assert_array_equal(f.variables['Streamflow'][:], 
+                                      np.vstack((flows[3:], more[3:])))
+        f.close()
+
+    def test_async_writer(self):
+        # Make sure the asynchronous writer writes all queued files, in order
+        outputs = {'out_type':'array', 'out_period':'file'}
+        out_dict = {'units':'m3/s', 'outlet_xs':[0, 1], 'outlet_ys':[0, 0],
+                    'lats':[0., 0.], 'lons':[0., 1.]}
+        time_dict = {'units':'days since 0001-01-01', 'cal':'noleap', 
+                     'long_name':'time'}
+        async_writer = start_async_writer(self.tmp_dir, outputs, out_dict, 
+                                          (2, ), {'async_writes':2, 
+                                                  'verbose':False})
+        flows = np.random.random((6, 2))
+        out_name = os.path.join(self.tmp_dir, 'flow.nc')
+        for i in xrange(6):
+            time_dict['time_step'] = np.array([i])
+            async_writer['tasks'].put(('streamflow', 'flux.nc', out_name, 
+                                       flows[i:i+1], dict(time_dict)))
+        counts = {'out_files':0}
+        stop_async_writer(async_writer, counts)
+        self.assertEqual(counts['out_files'], 6)
+        f = Dataset(out_name)
+        np.testing.assert_array_equal(f.variables['Streamflow'][:], flows[5:])
+        f.close()
+
+    def test_checkpoint(self):
+        # Make sure a checkpoint puts the ring back, matched by outlet
+        state_name = os.path.join(self.tmp_dir, 'state.ring')
+        ring = np.random.random((5, 3))
+        time_dict = {'out_state_time':np.arange(5.), 'units':'days', 
+                     'cal':'noleap'}
+        write_checkpoint(state_name, ring, time_dict, [0, 1, 2], [4, 5, 6])
+        self.assertTrue(is_checkpoint(state_name))
+        point_dict = OrderedDict([((2, 6), {}), ((0, 4), {}), ((1, 5), {})])
+        conv_dict = {'ring':np.zeros((7, 3))}
+        read_checkpoint(state_name, point_dict, conv_dict)
+        np.testing.assert_array_equal(conv_dict['ring'][:5], ring[:, [2, 0, 1]])
+        np.testing.assert_array_equal(conv_dict['ring'][5:], 0)
+
+    def test_checkpoint_chain(self):
+        # Make sure replaying base and delta checkpoints gives the ring of 
+        # each checkpoint
+        point_dict = OrderedDict()
+        point_dict[(0, 0)] = {'yi':np.array([0, 1]), 'xi':np.array([0, 1]),
+                              'uh':np.random.random((3, 2)), 
+                              'time':np.arange(3), 
+                              'time_offset':np.array([0, 2]), 'full_length':6}
+        conv_dict = make_conv_dict(point_dict, (2, 2))
+        time_dict = {'units':'days', 'cal':'noleap'}
+        chain = {}
+        for t in xrange(7):
+            flux = np.random.random((1, 2, 2))
+            convolve(point_dict, conv_dict, {'time_step':t}, flux, False, (1, ))
+            time_dict['out_state_time'] = conv_dict['time'] + t
+            state_name = os.path.join(self.tmp_dir, 'state_%i.chk' % t)
+            task = checkpoint_chain(chain, state_name, conv_dict, time_dict, 3)
+            write_task(task, None, {}, {}, (1, ))
+            self.assertEqual(task[2]['kind'], ['base', 'delta', 'delta'][t % 3])
+            np.testing.assert_array_equal(read_chain(state_name), 
+                                          unwrap_ring(conv_dict))
+
+    def test_prefetch_flux(self):
+        # Make sure prefetched fluxes come in order with the unit conversion
+        # of the first file, and a missing file is passed on as an error
+        flux_files = []
+        for i in xrange(3):
+            flux_files.append(os.path.join(self.tmp_dir, 'flux_%i.nc' % i))
+            f = Dataset(flux_files[-1], 'w')
+            f.output_frequency, f.output_mode = 'hourly', 'averaged'
+            f.createDimension('time', 1)
+            f.createDimension('y', 2)
+            f.createDimension('x', 3)
+            time = f.createVariable('time', 'f8', ('time', ))
+            time.units, time.calendar, time.long_name = 'days', 'noleap', 't'
+            time[:] = i
+            for name in ['Runoff', 'Baseflow']:
+                var = f.createVariable(name, 'f8', ('time', 'y', 'x'))
+                var.units = 'mm'
+                var[:] = i + 1.
+            f.close()
+        flux_queue = Queue.Queue()
+        prefetch_flux(flux_files + ['missing.nc'], flux_queue)
+        for i in xrange(3):
+            time_step, flux, flux_info = flux_queue.get()
+            self.assertEqual(time_step[0], i)
+            np.testing.assert_allclose(flux, 2*(i + 1.)/secsPerHour/mmPerMeter)
+        self.assertTrue(isinstance(flux_queue.get(), Exception))
+
+    def test_flux_cells(self):
+        # Make sure reading the contributing cells gives their fluxes of the
+        # full grid, for each read plan
+        flux_file = os.path.join(self.tmp_dir, 'flux.nc')
+        f = Dataset(flux_file, 'w')
+        f.output_frequency, f.output_mode = 'hourly', 'averaged'
+        f.createDimension('time', 2)
+        f.createDimension('y', 6)
+        f.createDimension('x', 5)
+        time = f.createVariable('time', 'f8', ('time', ))
+        time.units, time.calendar, time.long_name = 'days', 'noleap', 't'
+        time[:] = [0, 1]
+        for name in ['Runoff', 'Baseflow']:
+            var = f.createVariable(name, 'f8', ('time', 'y', 'x'))
+            var.units = 'mm'
+            var[:] = np.random.random((2, 6, 5))
+        f.close()
+        time_step, flux, flux_info = read_flux(flux_file)
+        conv_dict = {'sources':np.array([1, 3, 7, 21, 24, 29])}
+        for flux_read, strips in [('strips', 2), ('box', 1), ('full', 1)]:
+            cells = flux_cells(conv_dict, (6, 5), flux_read)
+            self.assertEqual(len(cells['strips']), strips)
+            np.testing.assert_array_equal(read_flux(flux_file, flux_info, 
+                                                    cells)[1],
+                                          flux.reshape(2, -1)[:, conv_dict['sources']])
+
+if __name__ == "__main__":
+    # only when run, ConvolutionBenchmarks imports random_point_dict
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestConvolutionFuctions)
+    unittest.TextTestRunner(verbosity=2).run(suite)
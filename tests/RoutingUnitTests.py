@@ -2,12 +2,302 @@
 
 import numpy as np
 from rout import *
+import os
+import shutil
+import tempfile
 import unittest
 
+def write_uh_box(tmp_dir):
+    # a flat 48 hour UH_BOX
+    uh_file = os.path.join(tmp_dir, 'uh_box.csv')
+    with open(uh_file, 'w') as f:
+        f.write('time,uh\n')
+        for t in xrange(48):
+            f.write('%i,%f\n' % (t*3600, 1./48))
+    return uh_file
+
+def small_domain():
+    # the 2x3 grid of test_flow_network, drains to the top right cell
+    return {'Basin_ID':np.ones((2, 3)), 
+            'Flow_Direction':np.array([[3, 3, 0], [1, 1, 1]]), 
+            'Flow_Distance':np.zeros((2, 3))+5000.,
+            'lat':np.array([41., 40.]), 'lon':np.array([1., 2., 3.]),
+            'direction_units':'VIC'}
+
 class TestConvolutionFuctions(unittest.TestCase):
 
-    def test_blank():
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_blank(self):
     	pass
+
+    def test_store_append(self):
+        # Two outlets appended to the store come back as contiguous ragged
+        # blocks in the order they were written
+        store = os.path.join(self.tmp_dir, 'store.nc')
+        times = np.arange(5)*86400.
+        uhs = [np.random.random((5, 3)), np.random.random((5, 4))]
+        for i, uh in enumerate(uhs):
+            n = uh.shape[1]
+            append_store(store, -120.+i, 40.+i, i+1, np.zeros(n), np.zeros(n),
+                         np.arange(n), np.arange(n), times, np.arange(5),
+                         '86400 seconds', uh, np.ones(n), 1., 2000., False)
+        outlets, points = read_store(store)
+        self.assertEqual(list(outlets['outlet_start']), [0, 3])
+        self.assertEqual(list(outlets['outlet_count']), [3, 4])
+        np.testing.assert_array_equal(points['unit_hydrograph'][:, 3:], uhs[1])
+
+    def test_reset_output(self):
+        # A rerun starts a new store instead of appending to the old one
+        store = os.path.join(self.tmp_dir, 'store.nc')
+        for run in xrange(2):
+            reset_output('store', store, False)
+            append_store(store, -120., 40., 1, np.zeros(3), np.zeros(3),
+                         np.arange(3), np.arange(3), np.arange(5)*86400., 
+                         np.arange(5), '86400 seconds', np.ones((5, 3)), 
+                         np.ones(3), 1., 2000., False)
+        outlets, points = read_store(store)
+        self.assertEqual(list(outlets['outlet_count']), [3])
+
+    def test_param_file_rerun(self):
+        # Two outlets sharing a cell are scaled back to the grid fraction, 
+        # a rerun starts a new parameter file and gives the same fractions
+        domain_file = os.path.join(self.tmp_dir, 'domain.nc')
+        f = Dataset(domain_file, 'w')
+        f.createDimension('nj', 1)
+        f.createDimension('ni', 3)
+        for var, data in [('yc', [[40., 40., 40.]]), ('xc', [[1., 2., 3.]]), 
+                          ('mask', [[1, 1, 1]]), ('area', [[1., 1., 1.]]),
+                          ('frac', [[1., 1., 1.]])]:
+            f.createVariable(var, 'f8', ('nj', 'ni'))[:] = data
+        f.close()
+        param_file = os.path.join(self.tmp_dir, 'params.nc')
+        uh = np.ones((4, 2))/4.
+        for run in xrange(2):
+            reset_output('rvic_params', param_file, False)
+            writer = open_param_writer(param_file, domain_file)
+            for x_outlet in [1, 2]:
+                append_param_file(writer, 1., 40., x_outlet, 0, 
+                                  np.array([0, x_outlet]), 
+                                  np.zeros(2, dtype=int), uh, 
+                                  np.array([0.75, 1.]), 86400, 0, 0, False)
+            close_param_writer(writer)
+            adjust_param_fractions(param_file, domain_file, False, chunk = 1)
+            f = Dataset(param_file, 'r')
+            np.testing.assert_allclose(f.variables['frac_point'][:], 
+                                       [0.5, 1., 0.5, 1.])
+            np.testing.assert_allclose(f.variables['uh_point'][0], 
+                                       [0.125, 0.25, 0.125, 0.25])
+            f.close()
+
+    def test_subset_offset(self):
+        # Subset UHs start at the first value above threshold and sum to one
+        uh = np.zeros((10, 2))
+        uh[3:6, 0] = 1.
+        uh[1:9, 1] = 1.
+        offset, out_uh, full_length = subset(uh, 4, 0.5)
+        self.assertEqual(list(offset), [3, 1])
+        self.assertEqual(full_length, 10)
+        np.testing.assert_allclose(out_uh.sum(axis=0), 1.)
+
+    def test_flow_network(self):
+        # 2x3 grid, top row flows east, bottom row flows north (VIC)
+        # into the top row, pour point is the top right cell
+        fdr = np.array([[3, 3, 0], [1, 1, 1]])
+        dist = np.ones(fdr.shape)
+        dy, dx = direction_offsets('VIC', False)
+        network = flow_network(fdr, dist, np.ones(fdr.shape), dy, dx, False)
+        self.assertEqual(list(network['downstream']), [1, 2, -1, 0, 1, 2])
+        self.assertEqual(list(network['count_ds']), [2, 1, 0, 3, 2, 1])
+        self.assertEqual(list(network['pour_point']), [2]*6)
+        up = network['up_ind'][network['up_ptr'][1]:network['up_ptr'][2]]
+        self.assertEqual(sorted(up), [0, 4])
+        order = list(network['topo_order'])
+        for cell, ds in enumerate(network['downstream']):
+            if ds >= 0:
+                self.assertTrue(order.index(ds) < order.index(cell))
+
+    def test_iter_rout(self):
+        # Stream the result of a small in memory domain, the 2x3 grid of
+        # test_flow_network drains to the top right cell
+        uh_file = write_uh_box(self.tmp_dir)
+        domain = small_domain()
+        results = iter_rout(None, uh_file, [41.], [3.], 1., 2000., False, 
+                            -9999., 2, 4, 1e-30, 86400, 86400, domain=domain)
+        result = results.next()
+        self.assertEqual(result['uh'].shape, (4, 6))
+        self.assertEqual(sorted(zip(result['yi'], result['xi'])), 
+                         [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)])
+        np.testing.assert_allclose(result['uh'].sum(axis=0), 1., rtol=1e-4)
+        self.assertRaises(StopIteration, results.next)
+
+    def test_service_rout(self):
+        # A request is routed with the service default velocity, requests 
+        # that can't be routed raise ValueError (400 from the service)
+        service['domain'] = small_domain()
+        service['network'] = None
+        service['args'] = {'infile':None, 'UHfile':write_uh_box(self.tmp_dir),
+                           'velocity':1., 'diffusion':2000., 'NODATA':-9999.,
+                           'CELL_FLOWTIME':2, 'BASIN_FLOWTIME':4, 
+                           'PREC':1e-30, 'OUTPUT_INTERVAL':86400, 
+                           'DAY_SECONDS':86400}
+        out_file, run_time = service_rout({'lat':41., 'lon':3., 
+                                           'out_path':self.tmp_dir})
+        self.assertEqual(os.path.dirname(out_file), self.tmp_dir)
+        f = Dataset(out_file, 'r')
+        self.assertEqual(f.velocity, 1.)
+        f.close()
+        for request in [{'lat':41.}, {'lat':'north', 'lon':3.}, [41., 3.],
+                        {'lat':41., 'lon':3., 'velocity':None},
+                        {'lat':41., 'lon':3., 'velocity':0}]:
+            self.assertRaises(ValueError, service_rout, request)
+        self.assertEqual(check_request({'lat':41., 'lon':3., 
+                                        'velocity':2})['velocity'], 2.)
+
+    def test_read_ascii_domain(self):
+        # The test_flow_network grid as ASCII rasters, parsed then cached
+        grids = {'Basin_ID':np.ones((2, 3)), 
+                 'Flow_Direction':np.array([[3, 3, 0], [1, 1, 1]]), 
+                 'Flow_Distance':np.zeros((2, 3))+5000.}
+        for var in grids:
+            with open(os.path.join(self.tmp_dir, var+'.asc'), 'w') as f:
+                f.write('ncols 3\nnrows 2\nxllcorner 0.5\nyllcorner 39.5\n'
+                        'cellsize 1\nNODATA_value -9999\n')
+                np.savetxt(f, grids[var], fmt='%g')
+        for cached in [False, True]:
+            domain = read_ascii_domain(self.tmp_dir, 1., 2000., False)
+            for var in grids:
+                np.testing.assert_array_equal(domain[var], grids[var])
+                self.assertEqual(isinstance(domain[var], np.memmap), True)
+            np.testing.assert_array_equal(domain['lat'], [41., 40.])
+            np.testing.assert_array_equal(domain['lon'], [1., 2., 3.])
+            self.assertEqual(domain['direction_units'], 'VIC')
+        self.assertEqual(os.path.exists(os.path.join(self.tmp_dir, 
+                                                     'Basin_ID.npy')), True)
+        # A positive NODATA_value, different from the other grids, is not 
+        # taken for an ARCMAP direction
+        os.remove(os.path.join(self.tmp_dir, 'Flow_Direction.npy'))
+        with open(os.path.join(self.tmp_dir, 'Flow_Direction.asc'), 'w') as f:
+            f.write('ncols 3\nnrows 2\nxllcorner 0.5\nyllcorner 39.5\n'
+                    'cellsize 1\nNODATA_value 255\n')
+            np.savetxt(f, [[3, 3, 255], [1, 1, 1]], fmt='%g')
+        domain = read_ascii_domain(self.tmp_dir, 1., 2000., False)
+        self.assertEqual(domain['direction_units'], 'VIC')
+
+        # ARCMAP codes 1, 2, 4 and 8 only are also VIC codes, read as VIC 
+        # unless direction_units says otherwise
+        os.remove(os.path.join(self.tmp_dir, 'Flow_Direction.npy'))
+        with open(os.path.join(self.tmp_dir, 'Flow_Direction.asc'), 'w') as f:
+            f.write('ncols 3\nnrows 2\nxllcorner 0.5\nyllcorner 39.5\n'
+                    'cellsize 1\nNODATA_value 255\n')
+            np.savetxt(f, [[1, 1, 0], [64, 64, 64]], fmt='%g')
+        domain = read_ascii_domain(self.tmp_dir, 1., 2000., False)
+        self.assertEqual(domain['direction_units'], 'ARCMAP')
+        os.remove(os.path.join(self.tmp_dir, 'Flow_Direction.npy'))
+        with open(os.path.join(self.tmp_dir, 'Flow_Direction.asc'), 'w') as f:
+            f.write('ncols 3\nnrows 2\nxllcorner 0.5\nyllcorner 39.5\n'
+                    'cellsize 1\nNODATA_value 255\n')
+            np.savetxt(f, [[1, 1, 0], [4, 4, 2]], fmt='%g')
+        domain = read_ascii_domain(self.tmp_dir, 1., 2000., False)
+        self.assertEqual(domain['direction_units'], 'VIC')
+        domain = read_ascii_domain(self.tmp_dir, 1., 2000., False, 
+                                   direction_units = 'ARCMAP')
+        self.assertEqual(domain['direction_units'], 'ARCMAP')
+
+    def test_upscale_domain(self):
+        # A 2x4 grid draining east upscaled to 1x2 target cells
+        in_file = os.path.join(self.tmp_dir, 'inputs.nc')
+        f = Dataset(in_file, 'w')
+        f.createDimension('lat', 2)
+        f.createDimension('lon', 4)
+        f.createVariable('lat', 'f8', ('lat', ))[:] = [41., 40.]
+        f.createVariable('lon', 'f8', ('lon', ))[:] = [1., 2., 3., 4.]
+        f.createVariable('Basin_ID', 'i4', ('lat', 'lon'))[:] = 1
+        fdr = f.createVariable('Flow_Direction', 'i4', ('lat', 'lon'))
+        fdr[:] = [[3, 3, 3, 0], [3, 3, 3, 0]]
+        fdr.units = 'VIC'
+        f.createVariable('Flow_Distance', 'f8', ('lat', 'lon'))[:] = 5000.
+        f.close()
+        domain_file = os.path.join(self.tmp_dir, 'domain.nc')
+        f = Dataset(domain_file, 'w')
+        f.createDimension('nj', 1)
+        f.createDimension('ni', 2)
+        for var, data in [('yc', [[40.5, 40.5]]), ('xc', [[1.5, 3.5]]), 
+                          ('mask', [[1, 1]]), ('area', [[1., 1.]])]:
+            f.createVariable(var, 'f8', ('nj', 'ni'))[:] = data
+        f.close()
+        domain = upscale_domain(in_file, domain_file, 1., 2000., False)
+        np.testing.assert_array_equal(domain['Flow_Direction'], [[3, 0]])
+        np.testing.assert_array_equal(domain['Flow_Distance'], 
+                                      [[10000., 5000.]])
+        np.testing.assert_array_equal(domain['Basin_ID'], [[2, 2]])
+
+    def test_upscale_domain_wrap(self):
+        # A global row draining west, the target cell at 360 holds the fine
+        # pour point and the cell at 90 drains west across the date line
+        in_file = os.path.join(self.tmp_dir, 'inputs.nc')
+        f = Dataset(in_file, 'w')
+        f.createDimension('lat', 1)
+        f.createDimension('lon', 8)
+        f.createVariable('lat', 'f8', ('lat', ))[:] = [0.]
+        f.createVariable('lon', 'f8', ('lon', ))[:] = np.arange(-22.5, 315., 45.)
+        f.createVariable('Basin_ID', 'i4', ('lat', 'lon'))[:] = 1
+        fdr = f.createVariable('Flow_Direction', 'i4', ('lat', 'lon'))
+        fdr[:] = [[0, 7, 7, 7, 7, 7, 7, 7]]
+        fdr.units = 'VIC'
+        f.createVariable('Flow_Distance', 'f8', ('lat', 'lon'))[:] = 5000.
+        f.close()
+        domain_file = os.path.join(self.tmp_dir, 'domain.nc')
+        f = Dataset(domain_file, 'w')
+        f.createDimension('nj', 1)
+        f.createDimension('ni', 4)
+        for var, data in [('yc', [[0., 0., 0., 0.]]), 
+                          ('xc', [[90., 180., 270., 360.]]), 
+                          ('mask', [[1, 1, 1, 1]]), ('area', [[1.]*4])]:
+            f.createVariable(var, 'f8', ('nj', 'ni'))[:] = data
+        f.close()
+        domain = upscale_domain(in_file, domain_file, 1., 2000., False)
+        np.testing.assert_array_equal(domain['Flow_Direction'], [[7, 7, 7, 0]])
+        np.testing.assert_array_equal(domain['Basin_ID'], [[4, 4, 4, 4]])
+
+        # The saved network remembers the target grid
+        network_file = os.path.join(self.tmp_dir, 'network')
+        make_network(in_file, network_file, False, domain = domain, 
+                     domain_file = domain_file)
+        network = load_network(network_file, in_file, False, 
+                               domain_file = domain_file)
+        np.testing.assert_array_equal(network['downstream'], [3, 0, 1, -1])
+        self.assertRaises(ValueError, load_network, network_file, in_file, 
+                          False)
+        self.assertRaises(ValueError, load_network, network_file, in_file, 
+                          False, domain_file = in_file)
+
+    def test_snap_outlets(self):
+        # Outlets in the same cell are only routed once, 1-D and 2-D grids
+        # snap to the same cells
+        lats, lons = np.array([41., 40.]), np.array([1., 2., 3.])
+        outlets = snap_outlets(lats, lons, [40.1, 41.2, 40.], [2.9, 1.1, 3.], 
+                               False)
+        self.assertEqual([loc for lat, lon, loc in outlets], [(1, 2), (0, 0)])
+        lon2d, lat2d = np.meshgrid(lons, lats)
+        outlets2d = snap_outlets(lat2d, lon2d, [40.1, 41.2, 40.], 
+                                 [2.9, 1.1, 3.], False)
+        self.assertEqual(outlets2d, outlets)
+
+    def test_nearest_1d(self):
+        # Same cells as find_nearest, ties and repeated values included, 
+        # for ascending and descending arrays
+        for array in [np.array([40., 41., 41., 42., 43.]), 
+                      np.array([43., 42., 41., 41., 40.]),
+                      np.arange(10.), np.arange(10.)[::-1]]:
+            values = np.arange(-1., 44., 0.25)
+            np.testing.assert_array_equal(nearest_1d(array, values),
+                                          [find_nearest(array, value) 
+                                           for value in values])
     
 suite = unittest.TestLoader().loadTestsFromTestCase(TestConvolutionFuctions)
 unittest.TextTestRunner(verbosity=2).run(suite)
@@ -12,6 +12,10 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import ImageGrid
 import argparse
+# subset is shared with the routing program (rout.subset)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             os.pardir, 'routing'))
+from rout import subset
 
 earthRadius = 6.37122e6 # meters
 # All indexes are zero based
@@ -326,16 +330,6 @@ def write_param_file(outFile, out_format, times, t_subset_length, t_full_length,
     f.domain_file = os.path.split(domain_file)[1]
     f.close()
 
-def subset(uh, subset, threshold):
-    full_length = uh.shape[0]
-    offset = np.empty(uh.shape[1], dtype = int)
-    out_uh = np.zeros((subset, uh.shape[1]))
-    for i in xrange(uh.shape[1]):
-        offset[i]  = np.nonzero(uh[:, i] > threshold)[0][0]     # find position of first index > threshold
-        end = np.minimum(uh.shape[0],offset[i]+subset)        # find end point
-        out_uh[:end-offset[i], i] = uh[offset[i]:end, i]/uh[offset[i]:end, i].sum() # clip and normalize
-    return offset, out_uh, full_length
-
 ##################################################################################
 ## Read netCDF Inputs
 ## Read data from input netCDF.